@@ -0,0 +1,256 @@
+'''
+Precomputed weight masks for the half-plane lightness difference in main.py.
+
+getLightnessDiffference splits a boxW x boxW square along a line through its center, at angle theta,
+and compares the average color on each side. The weight each pixel gets on each side only depends on
+boxW and theta, and getBestAngle only ever asks for angles on a grid of pi/256 (it bisects 8 times
+starting from -pi/2), so the masks are built once per boxW and reused for every square in the image.
+'''
+
+import numpy
+from math import pi, sin, atan, sqrt
+
+# getBestAngle halves its step 8 times starting at pi/2, so every angle it (and checkPoint) asks about
+# is a multiple of pi/256
+ANGLE_STEPS = 256
+
+
+class OffsetTable:
+    '''
+    The angle (as getTheta gives it) and the distance from the center of every integer offset
+    (i, j) in a box of width boxW. These never change for a given boxW, so they're worked out once here
+    instead of on every call. Arrays are indexed [i - lBound][j - lBound].
+    '''
+    def __init__(self, boxW):
+        self.boxW = boxW
+        self.lBound = int(0 - boxW/2)
+        self.hBound = boxW + self.lBound
+        
+        offsets = numpy.arange(self.lBound, self.hBound, dtype=float)
+        self.i, self.j = numpy.meshgrid(offsets, offsets, indexing='ij')
+        self.radius = numpy.zeros((boxW, boxW))
+        self.theta = numpy.zeros((boxW, boxW))
+        for i in range(self.lBound, self.hBound):
+            for j in range(self.lBound, self.hBound):
+                # same arithmetic as getTheta, so the values are identical to calling it
+                theta = atan( float(j) / (i+0.00001) )
+                if i < 0:
+                    theta += pi
+                elif j < 0:
+                    theta += pi * 2
+                self.theta[i - self.lBound][j - self.lBound] = theta
+                self.radius[i - self.lBound][j - self.lBound] = sqrt((i**2 + j**2))
+
+
+offsetTables = {}
+
+def getOffsetTable( boxW ):
+    if boxW not in offsetTables:
+        offsetTables[boxW] = OffsetTable(boxW)
+    return offsetTables[boxW]
+
+
+# builds the side1 and side2 weights for a square of width boxW, indexed the same way that
+# getLightnessDiffference indexes the square (offset i is read from sqr[i], so negative offsets wrap around)
+def getAngleMasks( boxW, theta ):
+    theta += 0.001
+    twoPi = pi + pi
+    table = getOffsetTable(boxW)
+    lBound = table.lBound
+    i = table.i
+    j = table.j
+    tempTheta = table.theta
+
+    # move each pixel's copy of the bounds around the circle until it's in the same turn as that pixel
+    lThetaBnd = numpy.full(i.shape, theta)
+    hThetaBnd = lThetaBnd + pi
+    move = (tempTheta < lThetaBnd) & (hThetaBnd > twoPi)
+    while move.any():
+        hThetaBnd[move] -= twoPi
+        lThetaBnd[move] -= twoPi
+        move = (tempTheta < lThetaBnd) & (hThetaBnd > twoPi)
+    move = (tempTheta > hThetaBnd) & (lThetaBnd < 0)
+    while move.any():
+        hThetaBnd[move] += twoPi
+        lThetaBnd[move] += twoPi
+        move = (tempTheta > hThetaBnd) & (lThetaBnd < 0)
+
+    distFromLine = table.radius * numpy.abs(numpy.tan(tempTheta - hThetaBnd))
+
+    #pretending the pixel is a circle whose radius goes from 0.5 to 1.0 as theta goes from 0 to pi/2
+    rPixel = 0.5 + 0.2071*sin(2*theta)
+    dPixel = rPixel + rPixel
+    partialPixelArea1 = distFromLine/dPixel + 0.5
+    partialPixelArea2 = 0.5 - distFromLine/dPixel
+
+    onLine = numpy.abs(distFromLine) < rPixel
+    inSide1 = (tempTheta > lThetaBnd) & (tempTheta < hThetaBnd)
+
+    side1 = numpy.where(inSide1, numpy.where(onLine, partialPixelArea1, 1), numpy.where(onLine, partialPixelArea2, 0))
+    side2 = numpy.where(inSide1, numpy.where(onLine, partialPixelArea2, 0), numpy.where(onLine, partialPixelArea1, 1))
+
+    # the centerline row (j == 0) is skipped entirely
+    side1[j == 0] = 0
+    side2[j == 0] = 0
+
+    # offset (i, j) is read from sqr[i][j], which python wraps around for negative offsets
+    side1 = numpy.roll(numpy.roll(side1, lBound, axis=0), lBound, axis=1)
+    side2 = numpy.roll(numpy.roll(side2, lBound, axis=0), lBound, axis=1)
+    return side1, side2
+
+# combines the two masks into one kernel, so that the lightness difference is a single weighted sum.
+# getLightnessDiffference adds each pixel's weight to the counts once per channel, so both averages
+# come out divided by 3; that's kept here so the thresholds elsewhere don't change.
+def getAngleKernel( boxW, theta ):
+    side1, side2 = getAngleMasks(boxW, theta)
+    return side1 / (3*side1.sum()) - side2 / (3*side2.sum())
+
+
+class KernelBank:
+    '''
+    Holds the kernels for one boxW. The kernels for all the angles on the pi/256 grid between -2pi and 2pi
+    (getBestAngle can wander as far as -3pi/2 while bisecting) are built the first time the bank is used,
+    stacked in one array; any other angle gets its kernel built on the spot.
+    '''
+    def __init__(self, boxW):
+        self.boxW = boxW
+        self.kernels = None
+
+    def build(self):
+        steps = range(-2*ANGLE_STEPS, 2*ANGLE_STEPS + 1)
+        self.kernels = numpy.array([ getAngleKernel(self.boxW, step * pi / ANGLE_STEPS) for step in steps ])
+
+    # the row of self.kernels holding each angle, or -1 for angles that aren't on the grid
+    def getIndices(self, thetas):
+        if self.kernels is None:
+            self.build()
+        thetas = numpy.asarray(thetas, dtype=float)
+        steps = numpy.rint(thetas * ANGLE_STEPS / pi)
+        onGrid = (numpy.abs(steps * pi / ANGLE_STEPS - thetas) < 1e-9) & (numpy.abs(steps) <= 2*ANGLE_STEPS)
+        return numpy.where(onGrid, steps + 2*ANGLE_STEPS, -1).astype(int)
+
+    def getKernels(self, thetas):
+        indices = self.getIndices(thetas)
+        kernels = self.kernels[indices]
+        for n in numpy.nonzero(indices < 0)[0]:
+            kernels[n] = getAngleKernel(self.boxW, float(numpy.ravel(thetas)[n]))
+        return kernels
+
+    def getKernel(self, theta):
+        return self.getKernels([theta])[0]
+
+    # the amount side1 is lighter than side2, per channel, for a stack of squares (n, boxW, boxW, channels)
+    # each with its own angle
+    def getDifferences(self, squares, thetas):
+        return numpy.einsum('nij,nijc->nc', self.getKernels(thetas), squares)
+
+    def getDifference(self, sqr, theta):
+        squares = numpy.asarray(sqr, dtype=float)[numpy.newaxis]
+        return self.getDifferences(squares, [theta])[0]
+
+    # getBestAngle for a stack of squares at once. Each square follows its own path through the
+    # bisection, so every step picks a different kernel per square.
+    def getBestAngles(self, squares):
+        usedTheta = numpy.full(len(squares), -pi / 2)
+        halfPrevMovement = pi
+        for i in range(0, 8):
+            diff = self.getDifferences(squares, usedTheta)
+            halfPrevMovement /= 2.0
+            usedTheta = numpy.where(diff.sum(axis=1) > 0, usedTheta - halfPrevMovement, usedTheta + halfPrevMovement)
+        return usedTheta + pi / 2
+
+
+banks = {}
+
+def getKernelBank( boxW ):
+    if boxW not in banks:
+        banks[boxW] = KernelBank(boxW)
+    return banks[boxW]
+
+
+class StructureTensorField:
+    '''
+    Edge angle and contrast for every pixel of an image, worked out in one pass from the image gradients
+    instead of bisecting with getLightnessDiffference at each point.
+
+    The orientation comes from the structure tensor (the channel-summed outer product of the gradient,
+    averaged over a boxW x boxW window), so gradients of opposite sign along an edge don't cancel out.
+    The averaged signed gradient then picks which way along the edge to face and gives the contrast.
+    A step of height H averages out to a gradient of H/boxW across the window, and the half-plane
+    difference of that step is H/3, so the gradient is scaled by boxW/3 to keep the same thresholds.
+    A diagonal edge runs further through the square window than an axis-aligned one, which is
+    corrected for by max(|cos|, |sin|) of the gradient direction.
+
+    Angles follow checkPoint's convention: the side the gradient points toward is at theta - pi/2.
+    '''
+    def __init__(self, image, boxW):
+        data = numpy.asarray(image, dtype=numpy.float32)
+        if data.ndim == 2:
+            data = data[:, :, numpy.newaxis]
+        self.boxW = boxW
+        self.theta, self.contrast = self.getField(data)
+
+    # the theta and contrast arrays for data, indexed [y, x, channel]
+    def getField(self, data):
+        from scipy.ndimage import uniform_filter
+
+        boxW = self.boxW
+        gy, gx = numpy.gradient(data, axis=(0, 1))
+
+        jxx = uniform_filter((gx*gx).sum(axis=2), size=boxW)
+        jxy = uniform_filter((gx*gy).sum(axis=2), size=boxW)
+        jyy = uniform_filter((gy*gy).sum(axis=2), size=boxW)
+        phi = 0.5 * numpy.arctan2(2*jxy, jxx - jyy)
+        del jxx, jxy, jyy
+
+        meanGx = uniform_filter(gx, size=(boxW, boxW, 1))
+        del gx
+        meanGy = uniform_filter(gy, size=(boxW, boxW, 1))
+        del gy
+
+        # the tensor only knows the orientation up to pi; face toward the lighter side
+        cosPhi = numpy.cos(phi)[:, :, numpy.newaxis]
+        sinPhi = numpy.sin(phi)[:, :, numpy.newaxis]
+        lengthInBox = numpy.maximum(numpy.abs(cosPhi), numpy.abs(sinPhi))
+        contrast = (meanGx*cosPhi + meanGy*sinPhi) * lengthInBox * (boxW / 3.0)
+        del lengthInBox
+        flip = contrast.sum(axis=2) < 0
+        phi[flip] += pi
+        contrast[flip] *= -1
+
+        theta = phi + pi/2
+        theta[theta > pi] -= 2*pi
+        return theta.astype(numpy.float32), contrast.astype(numpy.float32)
+
+    # recomputes every pixel whose window overlaps the rectangle [x0, x1) x [y0, y1) of pixels, which is
+    # indexed [x, y] like the pixel arrays in main. Call it after that part of the image changes.
+    def refresh(self, pixels, x0, y0, x1, y1):
+        height, width = self.theta.shape
+        margin = self.boxW
+        ox0 = max(int(x0) - margin, 0)
+        oy0 = max(int(y0) - margin, 0)
+        ox1 = min(int(x1) + margin, width)
+        oy1 = min(int(y1) + margin, height)
+        if ox1 <= ox0 or oy1 <= oy0:
+            return
+        # read another margin around the pixels being rewritten, so the filters see what they saw the first time
+        ix0 = max(ox0 - margin, 0)
+        iy0 = max(oy0 - margin, 0)
+        ix1 = min(ox1 + margin, width)
+        iy1 = min(oy1 + margin, height)
+        data = numpy.asarray(pixels[ix0:ix1, iy0:iy1], dtype=numpy.float32).transpose(1, 0, 2)
+        theta, contrast = self.getField(data)
+        self.theta[oy0:oy1, ox0:ox1] = theta[oy0 - iy0:oy1 - iy0, ox0 - ix0:ox1 - ix0]
+        self.contrast[oy0:oy1, ox0:ox1] = contrast[oy0 - iy0:oy1 - iy0, ox0 - ix0:ox1 - ix0]
+
+    # the edge angle and per-channel contrast at pixel (x, y), in the same form checkPoint returns them
+    def lookup(self, x, y):
+        x = int(x)
+        y = int(y)
+        return float(self.theta[y, x]), self.contrast[y, x]
+
+    # lookup for arrays of points at once
+    def lookupAll(self, xs, ys):
+        xs = numpy.asarray(xs, dtype=int)
+        ys = numpy.asarray(ys, dtype=int)
+        return self.theta[ys, xs], self.contrast[ys, xs]
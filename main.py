@@ -23,16 +23,25 @@ from numpy.linalg import *
 from numpy import *
 import numpy
 from scipy import optimize
+from scipy.ndimage import distance_transform_edt, uniform_filter, maximum_filter
+from scipy.spatial import cKDTree
 from audioop import avg
 import EllipseMath
 from scipy.constants.constants import foot
 from math import cos, sin, pi, sqrt
+import math
 from functools import total_ordering
 import os
+import sys
+import glob
+import json
 from html.parser import interesting_normal
 import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from scipy.cluster.vq import ClusterError
 from defer import AlreadyCalledDeferred
+from edgeKernels import getKernelBank, StructureTensorField
 
     
 def withinTol( color1, color2, tol ):
@@ -53,82 +62,196 @@ def getTheta(coord):
         theta += math.pi * 2
     return theta
 
+#getTheta for an array of (x, y) vectors at once, using arctan2. x gets the same small offset as in getTheta,
+#so that straight-back turns come out the same way
+def getThetas(coords):
+    coords = numpy.asarray(coords, dtype=float)
+    return numpy.arctan2(coords[..., 1], coords[..., 0] + 0.00001) % (2*pi)
 
 #function that will calculate the amount that side2 of a given 9x9 square is lighter than side1, 
 #based on an input rotation of the centerline. the centerline starts on the x-axis.
 #side1 is the centered at theta + pi/2
+#the per-pixel weights only depend on boxW and theta, so they come precomputed from a kernel bank
 def getLightnessDiffference( sqr, theta ):
-    theta += 0.001
-    side1 = [0,0,0]
-    side2 = [0,0,0]
-    boxW = len(sqr[0])
+    return getKernelBank(len(sqr[0])).getDifference(sqr, theta)
+
+#returns the color axis the image gets projected onto for channelMode, or None to keep all 3 channels:
+#    'rgb'       - no projection
+#    'luminance' - the usual luminance weights
+#    'principal' - the direction the image's colors vary the most in (first principal component)
+#the axis is signed so that lighter pixels project to larger values, like they are in each channel
+def getProjectionAxis( image, channelMode ):
+    if channelMode == 'rgb':
+        return None
+    if channelMode == 'luminance':
+        return numpy.array([0.299, 0.587, 0.114])
+    if channelMode == 'principal':
+        colors = numpy.asarray(image, dtype=float).reshape(-1, 3)
+        # a few hundred thousand pixels are plenty to find the axis
+        colors = colors[::max(1, int(len(colors) / 250000))]
+        values, vectors = numpy.linalg.eigh(numpy.cov(colors, rowvar=False))
+        axis = vectors[:, numpy.argmax(values)]
+        if axis.sum() < 0:
+            axis = -axis
+        return axis
+    raise Exception("unknown channelMode: " + str(channelMode))
+
+#converts an image into a pixel array: a contiguous (height, width, 3) array, returned as a view indexed
+#[x, y] like PIL's pixel access, so pixels[x, y] still gives a pixel and a square is a slice of it.
+#the values are signed, so that subtracting two pixels can't wrap around.
+#with an axis from getProjectionAxis, it's instead a single float channel: each pixel's color projected onto it
+def getPixelArray( image, axis = None ):
+    if axis is None:
+        return numpy.ascontiguousarray(numpy.asarray(image), dtype=numpy.int16).transpose(1, 0, 2)
+    projected = numpy.asarray(image, dtype=numpy.float32) @ numpy.asarray(axis, dtype=numpy.float32)
+    return numpy.ascontiguousarray(projected[:, :, numpy.newaxis]).transpose(1, 0, 2)
+
+class PaddedPixels:
+    '''
+    A pixel array with a border of fill pixels around it, without making the bigger array. It's indexed in the
+    bordered coordinates, like the bigger array would be, with either two slices or two (arrays of) indices.
+    Whatever lands in the border reads as fill, and writes only go to the part inside the image.
+    '''
+    def __init__(self, pixels, border, fill):
+        self.pixels = pixels
+        self.border = border
+        self.fill = numpy.asarray(fill, dtype=pixels.dtype)
+        self.dtype = pixels.dtype
+        self.ndim = 3
+        self.shape = (pixels.shape[0] + 2*border, pixels.shape[1] + 2*border, pixels.shape[2])
+
+    # the part of the rectangle [x0, x1) x [y0, y1) (bordered coordinates) that's inside the image,
+    # in the image's own coordinates
+    def getInside(self, x0, y0, x1, y1):
+        b = self.border
+        return (max(x0 - b, 0), max(y0 - b, 0),
+                min(x1 - b, self.pixels.shape[0]), min(y1 - b, self.pixels.shape[1]))
+
+    def __getitem__(self, key):
+        x, y = key
+        if isinstance(x, slice) and isinstance(y, slice):
+            x0, x1 = x.indices(self.shape[0])[:2]
+            y0, y1 = y.indices(self.shape[1])[:2]
+            i0, j0, i1, j1 = self.getInside(x0, y0, x1, y1)
+            b = self.border
+            # a view, when it's all inside
+            if (i0 == x0 - b) and (j0 == y0 - b) and (i1 == x1 - b) and (j1 == y1 - b):
+                return self.pixels[i0:i1, j0:j1]
+            region = numpy.empty((max(x1 - x0, 0), max(y1 - y0, 0), self.shape[2]), dtype=self.dtype)
+            region[:] = self.fill
+            if i1 > i0 and j1 > j0:
+                region[i0 + b - x0:i1 + b - x0, j0 + b - y0:j1 + b - y0] = self.pixels[i0:i1, j0:j1]
+            return region
+        # one pixel, the way getBestInRegion reads them
+        if isinstance(x, (int, numpy.integer)) and isinstance(y, (int, numpy.integer)):
+            i = x - self.border
+            j = y - self.border
+            if 0 <= i < self.pixels.shape[0] and 0 <= j < self.pixels.shape[1]:
+                return self.pixels[i, j]
+            return self.fill
+        xs = numpy.asarray(x) - self.border
+        ys = numpy.asarray(y) - self.border
+        inside = (xs >= 0) & (ys >= 0) & (xs < self.pixels.shape[0]) & (ys < self.pixels.shape[1])
+        values = self.pixels[numpy.clip(xs, 0, self.pixels.shape[0] - 1), numpy.clip(ys, 0, self.pixels.shape[1] - 1)]
+        return numpy.where(inside[..., numpy.newaxis], values, self.fill)
+
+    def __setitem__(self, key, value):
+        x, y = key
+        x0, x1 = x.indices(self.shape[0])[:2]
+        y0, y1 = y.indices(self.shape[1])[:2]
+        i0, j0, i1, j1 = self.getInside(x0, y0, x1, y1)
+        if i1 > i0 and j1 > j0:
+            b = self.border
+            value = numpy.asarray(value)
+            if value.ndim == 3:
+                value = value[i0 + b - x0:i1 + b - x0, j0 + b - y0:j1 + b - y0]
+            self.pixels[i0:i1, j0:j1] = value
+
+    # getSquares for this view: every (boxW, boxW) square, gathered straight from the image and the fill
+    def getSquares(self, boxW, xs, ys):
+        lBound = int(0 - boxW/2)
+        offsets = numpy.arange(lBound, boxW + lBound)
+        xs = numpy.asarray(xs).astype(int)[:, numpy.newaxis, numpy.newaxis] + offsets[:, numpy.newaxis]
+        ys = numpy.asarray(ys).astype(int)[:, numpy.newaxis, numpy.newaxis] + offsets[numpy.newaxis, :]
+        return self[xs, ys]
+
+    # the whole bordered array, for the things that need it all at once
+    def __array__(self, dtype = None):
+        region = self[0:self.shape[0], 0:self.shape[1]]
+        return region if dtype is None else region.astype(dtype)
+
+#fills the inside of outline in the pixel array with value, the way fillOutline fills it in on an image.
+#returns a mask of the pixels that actually changed, over the outline's bounding box, and its corner (x0, y0).
+def fillPixels( pixels, outline, value ):
+    mask, x0, y0 = getOutlineMask(outline)
+    x1 = x0 + mask.shape[0]
+    y1 = y0 + mask.shape[1]
+    region = numpy.array(pixels[x0:x1, y0:y1])
+    mask = mask[:region.shape[0], :region.shape[1]]
+    changed = numpy.zeros((x1 - x0, y1 - y0), dtype=bool)
+    changed[:region.shape[0], :region.shape[1]] = mask & (region != value).any(axis=2)
+    region[mask] = value
+    pixels[x0:x1, y0:y1] = region
+    return changed, x0, y0
+
+#moves every point of outline by (dx, dy)
+def shiftOutline( outline, dx, dy ):
+    return [ (p[0] + dx, p[1] + dy) for p in outline ]
+
+class Pyramid:
+    '''
+    A pixel array shrunk by scale in each direction, by averaging each scale x scale block, for traceMode
+    'pyramid'. It's laid out like the pixel array it came from (indexed [x, y]), so anything that reads a
+    pixel array can read it. boxW is the full size box shrunk to match, and cache holds the checkPoint
+    results for the shrunken array. Call refresh after the full array changes, to keep them all in step.
+    '''
+    def __init__(self, pixels, boxW, scale = 2, cacheSize = 100000):
+        self.scale = scale
+        # kept odd, like the full size box, so the square stays centred on its point
+        self.boxW = max(int(boxW / scale), 3)
+        if self.boxW % 2 == 0:
+            self.boxW += 1
+        self.cache = CheckPointCache(cacheSize) if cacheSize > 0 else None
+        self.width = int(pixels.shape[0] / scale)
+        self.height = int(pixels.shape[1] / scale)
+        self.pixels = numpy.zeros((self.height, self.width, pixels.shape[2]), dtype=numpy.float32).transpose(1, 0, 2)
+        self.refresh(pixels, 0, 0, pixels.shape[0], pixels.shape[1])
+
+    # re-averages every block that overlaps the rectangle [x0, x1) x [y0, y1) of the full array
+    def refresh(self, pixels, x0, y0, x1, y1):
+        s = self.scale
+        x0 = max(int(x0 / s), 0)
+        y0 = max(int(y0 / s), 0)
+        x1 = min(int((x1 + s - 1) / s), self.width)
+        y1 = min(int((y1 + s - 1) / s), self.height)
+        if x1 <= x0 or y1 <= y0:
+            return
+        block = pixels[x0*s:x1*s, y0*s:y1*s].astype(numpy.float32)
+        self.pixels[x0:x1, y0:y1] = block.reshape(x1 - x0, s, y1 - y0, s, -1).mean(axis=(1, 3))
+        if self.cache is not None:
+            self.cache.invalidate(x0, y0, x1, y1, self.boxW)
+
+#getSquare for many points at once, from a pixel array. Returns an (n, boxW, boxW, channels) array
+def getSquares( pixels, boxW, xs, ys ):
+    if isinstance(pixels, PaddedPixels):
+        return pixels.getSquares(boxW, xs, ys)
     lBound = int(0 - boxW/2)
-    hBound = boxW + lBound #ensures odd boxW's don't result in too short a range due to integer division
-    s1Count = 0
-    s2Count = 0
-
-    for i1 in range(lBound, hBound):
-        for j1 in range(lBound, hBound):
-            if j1 == 0:
-                continue
-            i = i1
-            j = j1
-            
-            tempTheta = getTheta( (i, j) )
-            lThetaBnd = theta
-            hThetaBnd = theta + math.pi
-            twoPi = math.pi + math.pi
-            while (tempTheta < lThetaBnd) & (hThetaBnd > twoPi):
-                hThetaBnd -= twoPi
-                lThetaBnd -= twoPi
-            while (tempTheta > hThetaBnd) & (lThetaBnd < 0):
-                hThetaBnd += twoPi
-                lThetaBnd += twoPi
-                
-            distFromLine = sqrt((i**2 +j**2))*abs(math.tan(tempTheta - hThetaBnd))
-#             distFromLine = ((abs(i)+abs(j))/1.372)*abs(tan(tempTheta - hThetaBnd))
-            
-            #pretending the pixel is a circle whose radius goes from 0.5 to 1.0 as theta goes from 0 to pi/2
-            rPixel = 0.5 + 0.2071*sin(2*theta)
-            dPixel = rPixel+rPixel
-            partialPixelArea1 = distFromLine/dPixel + 0.5
-            partialPixelArea2 = 0.5 - distFromLine/dPixel
-            if (tempTheta > lThetaBnd) & ( tempTheta < hThetaBnd):
-
-                for k in range(0,3):
-                    if abs(distFromLine) < rPixel:
-                        
-                        side1[k] += sqr[i1][j1][k] * partialPixelArea1
-                        s1Count += partialPixelArea1
-                        side2[k] += sqr[i1][j1][k] * partialPixelArea2
-                        s2Count += partialPixelArea2
-                    else:
-                        side1[k] += sqr[i1][j1][k]
-                        s1Count += 1
-            else:
-#                     im.putpixel((i+x,j+y), (255,0,0))
-                for k in range(0,3):
-                    if abs(distFromLine) < rPixel:
-                        # a little more than half the width of a single pixel 
-                        # I'm pretending the pixel's a circle, and r=0.56 gives the circle an equal area to a 1x1 square
-                        side2[k] += sqr[i1][j1][k] * partialPixelArea1
-                        s2Count += partialPixelArea1
-                        side1[k] += sqr[i1][j1][k] * partialPixelArea2
-                        s1Count += partialPixelArea2
-                    else:
-                        side2[k] += sqr[i1][j1][k]
-                        s2Count += 1
+    xs = numpy.asarray(xs).astype(int)
+    ys = numpy.asarray(ys).astype(int)
+    windows = numpy.lib.stride_tricks.sliding_window_view(pixels, (boxW, boxW), axis=(0, 1))
+    return windows[xs + lBound, ys + lBound].transpose(0, 2, 3, 1)
 
-    difference = [0,0,0]
-    for i1 in range(0,3):
-        difference[i1] = side1[i1]/s1Count - side2[i1]/s2Count
-        
-    return difference
-  
+#with a pixel array, the square is a view into it rather than a copy
 def getSquare( pixels, boxW, x, y ):
-    square = []
     lBound = int(0 - boxW/2)
     hBound = boxW + lBound
+    if isinstance(pixels, (numpy.ndarray, PaddedPixels)):
+        x = int(x)
+        y = int(y)
+        if (x + lBound < 0) or (y + lBound < 0) or (x + hBound > pixels.shape[0]) or (y + hBound > pixels.shape[1]):
+            raise IndexError("square at " + str((x, y)) + " is off the image")
+        return pixels[x + lBound:x + hBound, y + lBound:y + hBound]
+    square = []
     for i in range(lBound, hBound):
         square.append([])
         for j in range(lBound, hBound):
@@ -171,8 +294,9 @@ def getLineMatrix( p1, p2 ):
     return line
     
 def getSqrAvg(sqr):
-    total = [0] * 3
-    for c in range(0, 3):
+    channels = len(sqr[0][0])
+    total = [0] * channels
+    for c in range(0, channels):
         for i in range(0, len(sqr)):
             for j in range(0, len(sqr)):
                 total[c] += sqr[i][j][c]
@@ -194,24 +318,19 @@ def getNetDeltaAngle(outline, index, a, b, includeBounds = 0):
     # idx is starting index
     # a is number of places to look behind
     # b is the number to look ahead
-    netAngle = 0;
-    for i in range( index - a + 1 - includeBounds, index + b + includeBounds):
-        p1 = outline[(i-1)%len(outline)]
-        p2 = outline[i%len(outline)]
-        v1 = getVector(p1,p2)
-        
-        p3 = outline[i%len(outline)]
-        p4 = outline[(i+1)%len(outline)]
-        v2 = getVector(p3,p4)
-
-        t = getTheta(v2) - getTheta(v1)
-        while t > pi:
-            t -= 2*pi
-        while t < -pi:
-            t += 2*pi
-#         print("    ", p1,p2,p3,p4, t)
-        netAngle += t
-    return netAngle
+    # all the turns are found at once; v1 goes into each point and v2 comes out of it
+    points = numpy.asarray(outline)
+    idx = numpy.arange(index - a + 1 - includeBounds, index + b + includeBounds)
+    if len(idx) == 0:
+        return 0
+    p1 = points[(idx-1) % len(outline)]
+    p2 = points[idx % len(outline)]
+    p4 = points[(idx+1) % len(outline)]
+    t = getThetas(p4 - p2) - getThetas(p2 - p1)
+    t = numpy.where(t > pi, t - 2*pi, t)
+    t = numpy.where(t < -pi, t + 2*pi, t)
+#     print("    ", p1,p2,p3,p4, t)
+    return float(t.sum())
 
 
 # l = [(0,0),(1,1),(2,1),(3,1),(4,0),(3,-1),(1,-1)]
@@ -283,30 +402,100 @@ def getNextPoint(pixels, w, h, boxW, skipSize, i, j, t, veryHighContrast):
     return nxtP, bestT
     
     
-def getOutline(pixels, w, h, boxW, maxLength, i, j, avg, stdev):
+class AdaptiveStep:
+    '''
+    How far getOutline steps along the edge, for stepMode 'adaptive'. Along a nearly straight stretch of
+    boundary the step is lengthened by growth at every point, up to maxStep; as soon as the edge angle turns
+    by more than maxTurn in one step, or the edge gets less than half as strong as it was at the last point,
+    it goes back to minStep. A step that's too long to find the next point is also retried at minStep.
+    Since the turn per step grows with the step, the step settles at about radius * maxTurn on a curve.
+    getOutline fills in the points between the ends of a long step, so only the searches are saved.
+    Keeps count of the steps taken and their total length, to tell how many steps of minStep were saved.
+    '''
+    def __init__(self, minStep = 1.7 * sqrt(2), maxStep = 2 * 1.7 * sqrt(2), growth = 1.5, maxTurn = pi / 32):
+        self.minStep = minStep
+        self.maxStep = max(maxStep, minStep)
+        self.growth = growth
+        self.maxTurn = maxTurn
+        self.steps = 0
+        self.length = 0.0
+    
+    # the step to take after one of length step, where the edge angle turned by turn and its contrast
+    # went from prevStrength to strength
+    def next(self, step, turn, strength, prevStrength):
+        # the smallest angle between the two, either way round
+        turn = abs((turn + pi) % (2*pi) - pi)
+        if turn > self.maxTurn or strength < prevStrength / 2:
+            return self.minStep
+        if turn < self.maxTurn / 2:
+            return min(step * self.growth, self.maxStep)
+        return step
+    
+    # counts a step of length step
+    def count(self, step):
+        self.steps += 1
+        self.length += step
+    
+    # how many more steps it would have taken to cover the same length at minStep
+    def getSaved(self):
+        return int(round(self.length / self.minStep)) - self.steps
+    
+    def __str__(self):
+        fixed = self.steps + self.getSaved()
+        rate = self.getSaved() / fixed if fixed > 0 else 0
+        return "adaptive step: {0} steps, {1} saved ({2:.1%}) against a fixed step of {3:.2f}".format(
+            self.steps, self.getSaved(), rate, self.minStep)
+
+#makes the AdaptiveStep for stepMode 'adaptive', or None for 'fixed'. minStep and maxStep default to AdaptiveStep's.
+def getStepper( stepMode = 'fixed', minStep = None, maxStep = None ):
+    if stepMode == 'fixed':
+        return None
+    elif stepMode == 'adaptive':
+        if minStep is None:
+            minStep = 1.7 * sqrt(2)
+        if maxStep is None:
+            maxStep = 2 * minStep
+        return AdaptiveStep(minStep, maxStep)
+    else:
+        raise Exception("unknown stepMode: " + str(stepMode))
+
+#traces the edge that the point (i, j) is on, one step of skipSize at a time. With an AdaptiveStep as stepper,
+#the step changes with the curvature of the edge instead, from stepper.minStep to stepper.maxStep.
+def getOutline(pixels, w, h, boxW, maxLength, i, j, avg, stdev, field = None, cache = None, skipSize = 1.7 * sqrt(2), searchSize = 2,
+               stepper = None):
     print("Tracing outline, starting at", i, j)
     veryHighContrast = [x/3 for x in stdev]
     lowContrast = [x/8 for x in stdev]
     '''
     input is the first boundary point.
     '''
-    skipSize = 1.7 * sqrt(2)
     outline = []
     prevP = (i, j)
     firstP = prevP
     outline.append(prevP)
 
-    footprints = numpy.zeros(shape=(w,h))
+    # every pixel the outline has passed over so far; a set, so it only grows with the outline
+    footprints = set()
 #####
-    sqr = getSquare(pixels, boxW, i, j)
-    t = getBestAngle(sqr)
+    if field is None:
+        sqr = getSquare(pixels, boxW, i, j)
+        t = getBestAngle(sqr)
+    else:
+        t = field.lookup(i, j)[0]
 #####
     cutOffSqrDist = (3*skipSize)**2
 #     print(firstP,"__")
+    step = skipSize
+    strength = None
+    if stepper is not None:
+        step = stepper.minStep
 
     while True:
         if len(outline) > 15:
             dist = sqrDist(prevP, outline[0])
+            # don't step over the start
+            if stepper is not None and dist <= (3*skipSize + step)**2:
+                step = stepper.minStep
 
             if dist <= cutOffSqrDist:
                 print(firstP, "close to start", len(outline))
@@ -323,15 +512,33 @@ def getOutline(pixels, w, h, boxW, maxLength, i, j, avg, stdev):
 #          
 #         nxtP, t = getNextPoint(pixels, w, h, boxW, skipSize, i, j, t, veryHighContrast)
 ####
-        i += skipSize * math.cos(t)
-        j += skipSize * math.sin(t)
+        i += step * math.cos(t)
+        j += step * math.sin(t)
+        stepTaken = step
  
-        nxtP, t, diff = getBestInRegion(pixels, w, h, boxW, i, j, 2, skipSize, prevP, avg, lowContrast)
+        nxtP, nxtT, diff = getBestInRegion(pixels, w, h, boxW, i, j, searchSize, skipSize, prevP, avg, lowContrast, field, cache)
         nxtP = (int(nxtP[0]), int(nxtP[1]))
 ####
 
         i,j = nxtP
 
+        if stepper is not None:
+            if step > stepper.minStep:
+                looping = False
+                if nxtP != (0,0) and nxtP != prevP:
+                    for p in getLineMatrix(prevP, nxtP):
+                        if p in footprints:
+                            looping = True
+                # a long step that didn't find the next point gets another try at the shortest step
+                if nxtP == (0,0) or nxtP == prevP or looping:
+                    i,j = prevP
+                    step = stepper.minStep
+                    continue
+            
+            newStrength = float(numpy.abs(diff).sum())
+            step = stepper.next(step, nxtT - t, newStrength, strength if strength is not None else 0)
+            strength = newStrength
+        t = nxtT
         
         if nxtP == (0,0):
             print(firstP, "No valid next point", prevP, len(outline))
@@ -346,7 +553,7 @@ def getOutline(pixels, w, h, boxW, maxLength, i, j, avg, stdev):
         
         line = getLineMatrix( prevP, nxtP)
         for p in line:
-            if footprints[p[0]][p[1]] != 0:
+            if p in footprints:
                 looping = True
         if looping:
             # means that nxtP and prevP are on either side of a previously drawn line; means that that section
@@ -371,9 +578,16 @@ def getOutline(pixels, w, h, boxW, maxLength, i, j, avg, stdev):
             print(firstP, "Went off-screen", len(outline))
             break
         
+        if stepper is not None:
+            stepper.count(stepTaken)
+            # a long step was only taken where the edge is straight, so the points that steps of minStep would
+            # have found are put in along the line. The outline stays spaced as splitOutline expects.
+            n = int(round(stepTaken / stepper.minStep))
+            for k in range(1, n):
+                outline.append((int(prevP[0] + (nxtP[0] - prevP[0]) * k / n), int(prevP[1] + (nxtP[1] - prevP[1]) * k / n)))
         outline.append(nxtP)
-        for p in line: # this marks footprints both at and between each point
-            footprints[p[0]][p[1]] = len(outline)
+        # this marks footprints both at and between each point
+        footprints.update(line)
         prevP = nxtP
         
         '''
@@ -382,6 +596,83 @@ def getOutline(pixels, w, h, boxW, maxLength, i, j, avg, stdev):
         
     return outline
 
+#moves each of points onto the strongest edge in the (2r+1) x (2r+1) block of pixels around it, with every block
+#checked in one batch. returns the moved points, with None for any point whose block has no square that fits on the image.
+def snapToEdges(pixels, w, h, boxW, points, r, field = None, cache = None):
+    margin = boxW/2 + 1
+    candidates = []
+    owners = []
+    for n in range(0, len(points)):
+        x, y = points[n]
+        for dj in range(-r, r+1):
+            for di in range(-r, r+1):
+                if (x + di - margin >= 0) and (y + dj - margin >= 0) and (x + di + margin < w) and (y + dj + margin < h):
+                    candidates.append((x + di, y + dj))
+                    owners.append(n)
+    snapped = [None] * len(points)
+    if len(candidates) == 0:
+        return snapped
+    
+    if cache is not None:
+        diffs = numpy.array([ diff for theta, diff in cache.checkPoints(pixels, boxW, candidates, field) ])
+    else:
+        xs = [ p[0] for p in candidates ]
+        ys = [ p[1] for p in candidates ]
+        squares = None
+        if field is None:
+            squares = getSquares(pixels, boxW, xs, ys)
+        diffs = checkPoints(squares, field, (xs, ys))[1]
+    strength = numpy.abs(diffs).sum(axis=1)
+    
+    # the first of the strongest candidates of each point
+    best = {}
+    for m in range(0, len(candidates)):
+        n = owners[m]
+        if n not in best or strength[m] > strength[best[n]]:
+            best[n] = m
+    for n in best:
+        snapped[n] = candidates[best[n]]
+    return snapped
+
+#getOutline for traceMode 'pyramid'. The outline is first traced on the shrunken copy of the image in pyramid,
+#with boxW and the search shrunk to match, so every square has a quarter of the pixels, and with the usual step,
+#which covers scale times as much of the fiber. Each of its points is then scaled back up and moved onto the
+#strongest edge in the scale x scale block of pixels around it. Those points are scale times further apart than
+#getOutline's, so points spaced like a full size trace (spacing apart) are put in along the line between each pair,
+#and moved onto the strongest edge in the 3 x 3 block around them.
+def getPyramidOutline(pixels, pyramid, w, h, boxW, maxLength, i, j, avg, stdev, field = None, cache = None, stepper = None,
+                      spacing = 4):
+    s = pyramid.scale
+    coarse = getOutline(pyramid.pixels, pyramid.width, pyramid.height, pyramid.boxW, maxLength / s, int(i / s), int(j / s),
+                        avg, stdev, None, pyramid.cache, 1.7 * sqrt(2), 1, stepper)
+    
+    vertices = [ (int(p[0] * s + s/2), int(p[1] * s + s/2)) for p in coarse ]
+    vertices = [ p for p in snapToEdges(pixels, w, h, boxW, vertices, int(s/2), field, cache) if p is not None ]
+    
+    # the points in between each pair of vertices, and which gap each one is in
+    between = []
+    gaps = []
+    for n in range(1, len(vertices)):
+        p = vertices[n-1]
+        q = vertices[n]
+        count = int(sqrt(sqrDist(p, q)) / spacing + 0.5)
+        for k in range(1, count):
+            between.append((int(p[0] + (q[0] - p[0]) * k / count + 0.5), int(p[1] + (q[1] - p[1]) * k / count + 0.5)))
+            gaps.append(n)
+    between = snapToEdges(pixels, w, h, boxW, between, 1, field, cache)
+    
+    outline = []
+    m = 0
+    for n in range(0, len(vertices)):
+        while m < len(between) and gaps[m] == n:
+            if between[m] is not None and (len(outline) == 0 or between[m] != outline[len(outline)-1]):
+                outline.append(between[m])
+            m += 1
+        p = vertices[n]
+        if len(outline) == 0 or p != outline[len(outline)-1]:
+            outline.append(p)
+    return outline
+
 #this returns an angle measured from the x-axis. White is pi below this angle, black is pi above.
 #it works analogously to a binary search. If the value it calculates is negative, it turns one way.
 # if it's positive, it turns the other. The amount it turns is half of the amount it turned the previous time.
@@ -420,7 +711,11 @@ def getBestAngle(sqr):
 
     return usedTheta + math.pi / 2
 
-def checkPoint( square ):
+#if a StructureTensorField is given, the angle and difference at p are looked up from it instead,
+#and square isn't used
+def checkPoint( square, field = None, p = None ):
+    if field is not None:
+        return field.lookup(p[0], p[1])
     
     theta = getBestAngle(square)
     diff = getLightnessDiffference(square, theta)
@@ -428,7 +723,156 @@ def checkPoint( square ):
     return theta, diff
 
 
-def getBestInRegion( pixels, width, height, boxW, x, y, searchSize, skipSize, prevP, avg, tol ):
+class CheckPointCache:
+    '''
+    Remembers the results of checkPoint by pixel and boxW, since getOutline's search windows overlap a lot
+    from one step to the next and the grid scan often lands on points a trace has already looked at.
+    Holds at most maxSize results, dropping the least recently used one when it's full.
+    '''
+    def __init__(self, maxSize = 100000):
+        self.maxSize = maxSize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    # same as checkPoint(getSquare(pixels, boxW, x, y), field, (x, y))
+    def checkPoint(self, pixels, boxW, x, y, field = None):
+        key = (int(x), int(y), boxW)
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+        self.misses += 1
+        square = None
+        if field is None:
+            square = getSquare(pixels, boxW, x, y)
+        result = checkPoint(square, field, (x, y))
+        self.store(key, result)
+        return result
+    
+    def store(self, key, result):
+        self.results[key] = result
+        if len(self.results) > self.maxSize:
+            self.results.popitem(last = False)
+    
+    # the cached version of checkPoints, for a list of (x, y) points. Only the ones not already
+    # stored get evaluated, together in one batch.
+    def checkPoints(self, pixels, boxW, points, field = None):
+        results = [None] * len(points)
+        missing = []
+        for n in range(0, len(points)):
+            key = (int(points[n][0]), int(points[n][1]), boxW)
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                results[n] = self.results[key]
+            else:
+                missing.append(n)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            xs = [ points[n][0] for n in missing ]
+            ys = [ points[n][1] for n in missing ]
+            squares = None
+            if field is None:
+                squares = getSquares(pixels, boxW, xs, ys)
+            thetas, diffs = checkPoints(squares, field, (xs, ys))
+            for m in range(0, len(missing)):
+                results[missing[m]] = (thetas[m], diffs[m])
+                self.store((int(xs[m]), int(ys[m]), boxW), results[missing[m]])
+        return results
+    
+    # forgets every result whose square overlaps the rectangle [x0, x1) x [y0, y1), after those pixels were changed.
+    # changed can be a mask of the rectangle, to only forget the results whose square overlaps a changed pixel.
+    def invalidate(self, x0, y0, x1, y1, boxW, changed = None):
+        lBound = int(0 - boxW/2)
+        hBound = boxW + lBound
+        # the points whose square reaches into the rectangle
+        px0 = x0 - hBound + 1
+        py0 = y0 - hBound + 1
+        if changed is None:
+            affected = numpy.ones((x1 - lBound - px0, y1 - lBound - py0), dtype=bool)
+        else:
+            if not changed.any():
+                return
+            padded = numpy.zeros((x1 - lBound - px0, y1 - lBound - py0), dtype=bool)
+            padded[x0 - px0:x1 - px0, y0 - py0:y1 - py0] = changed
+            # the window maximum_filter takes around each point is the square getSquare takes
+            affected = maximum_filter(padded, size=boxW, mode='constant')
+        # go through whichever is shorter, the stored results or the affected points
+        if len(self.results) < affected.size:
+            for key in [ k for k in self.results if k[2] == boxW ]:
+                i = key[0] - px0
+                j = key[1] - py0
+                if 0 <= i < affected.shape[0] and 0 <= j < affected.shape[1] and affected[i, j]:
+                    del self.results[key]
+        else:
+            for i, j in zip(*numpy.nonzero(affected)):
+                self.results.pop((int(i) + px0, int(j) + py0, boxW), None)
+    
+    def __str__(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total > 0 else 0
+        return "checkPoint cache: {0} hits, {1} misses ({2:.1%} hit rate), {3} stored".format(self.hits, self.misses, rate, len(self.results))
+
+#checkPoint for a whole stack of squares at once, of shape (n, boxW, boxW, channels).
+#returns an array of angles and an (n, channels) array of differences.
+#with a StructureTensorField, the values are looked up at points = (xs, ys) instead and squares isn't used.
+def checkPoints( squares, field = None, points = None ):
+    if field is not None:
+        return field.lookupAll(points[0], points[1])
+    bank = getKernelBank(squares.shape[1])
+    thetas = bank.getBestAngles(squares)
+    return thetas, bank.getDifferences(squares, thetas)
+
+#runs the sqrOk and checkPoint tests of the standAlone scan on every point of the grid at once.
+#pixels is the (padded) pixel array, and gridX and gridY are the x and y values of the grid.
+#returns the points whose difference is bigger than tol, in the order given by order:
+#    'raster' - rows of the grid, one after the other, the order the plain scan visits them in
+#    'strongest' - strongest first, so the clearest edges get traced before the fainter ones next to them
+#withStrengths also returns how far each point's difference is over tol, the value 'strongest' sorts by.
+def getCandidateMap( pixels, boxW, gridX, gridY, tol, field = None, chunkSize = 4096, order = 'raster', withStrengths = False ):
+    data = pixels
+    absTol = numpy.abs(numpy.asarray(tol, dtype=float))
+    
+    # same order as the plain scan; rows of the grid, one after the other
+    ys, xs = numpy.meshgrid(numpy.asarray(gridY), numpy.asarray(gridX), indexing='ij')
+    xs = xs.ravel()
+    ys = ys.ravel()
+    lBound = int(0 - boxW/2)
+    hBound = boxW + lBound
+    
+    # sqrOk only looks at the corners of each square
+    diag1 = data[xs + lBound, ys + lBound] - data[xs + hBound - 1, ys + hBound - 1]
+    diag2 = data[xs + lBound, ys + hBound - 1] - data[xs + hBound - 1, ys + lBound]
+    ok = ((numpy.abs(diag1) - absTol).sum(axis=1) > 0) | ((numpy.abs(diag2) - absTol).sum(axis=1) > 0)
+    xs = xs[ok]
+    ys = ys[ok]
+    
+    strength = numpy.zeros(len(xs))
+    for start in range(0, len(xs), chunkSize):
+        x = xs[start:start + chunkSize]
+        y = ys[start:start + chunkSize]
+        squares = None
+        if field is None:
+            squares = getSquares(data, boxW, x, y)
+        diffs = checkPoints(squares, field, (x, y))[1]
+        strength[start:start + chunkSize] = (numpy.abs(diffs) - absTol).sum(axis=1)
+    
+    good = numpy.nonzero(strength > 0)[0]
+    if order == 'strongest':
+        good = good[numpy.argsort(-strength[good], kind='stable')]
+    elif order != 'raster':
+        raise Exception("unknown candidate order: " + str(order))
+    points = [ (int(xs[n]), int(ys[n])) for n in good ]
+    if withStrengths:
+        return points, strength[good].tolist()
+    return points
+
+
+#with batch, the points that pass the checks below are all handed to checkPoints at once, instead of
+#checking each one as it's found. The result is the same either way.
+def getBestInRegion( pixels, width, height, boxW, x, y, searchSize, skipSize, prevP, avg, tol, field = None, cache = None, batch = True ):
+    candidates = []
     bestDiff = [0,0,0]
     bestT = 0
     bestP = (0,0)
@@ -490,10 +934,20 @@ def getBestInRegion( pixels, width, height, boxW, x, y, searchSize, skipSize, pr
 
                 #if it's on the screen
                 if pointIsGood & (x + i < width - boxW/2) & (y + j < height - boxW/2):
-
-                    square = getSquare(pixels, boxW, x + i, y + j)
                     
-                    theta, diff = checkPoint(square)
+                    if batch:
+                        candidates.append((x + i, y + j))
+                        continue
+
+                    if cache is not None:
+                        theta, diff = cache.checkPoint(pixels, boxW, x + i, y + j, field)
+                    else:
+                        if field is None:
+                            square = getSquare(pixels, boxW, x + i, y + j)
+                        else:
+                            square = None
+                        
+                        theta, diff = checkPoint(square, field, (x + i, y + j))
                     if prevP == (81, 100):
                         print(theta, diff, bestDiff, i, j)
                     if absBiggerThan(diff, bestDiff):
@@ -501,6 +955,24 @@ def getBestInRegion( pixels, width, height, boxW, x, y, searchSize, skipSize, pr
                         bestT = theta
                         bestP = (x + i, y + j)
 
+    if len(candidates) > 0:
+        if cache is not None:
+            results = cache.checkPoints(pixels, boxW, candidates, field)
+        else:
+            xs = [ p[0] for p in candidates ]
+            ys = [ p[1] for p in candidates ]
+            squares = None
+            if field is None:
+                squares = getSquares(pixels, boxW, xs, ys)
+            thetas, diffs = checkPoints(squares, field, (xs, ys))
+            results = zip(thetas, diffs)
+        # the first of the strongest, same as comparing them one by one in order
+        for p, (theta, diff) in zip(candidates, results):
+            if absBiggerThan(diff, bestDiff):
+                bestDiff = diff
+                bestT = theta
+                bestP = p
+
     return bestP, bestT, bestDiff
         
 
@@ -550,6 +1022,8 @@ def sumVec(v1,v2):
     return (v1[0]+v2[0], v1[1]+v2[1], v1[2]+v2[2])
 
 def diffVec(v1,v2):
+    if len(v1) != 3:
+        return tuple( v1[i]-v2[i] for i in range(0, len(v1)) )
     v = (v1[0]-v2[0], v1[1]-v2[1], v1[2]-v2[2])
     return v
 
@@ -593,11 +1067,13 @@ def getSlice(outline, i1,i2):
     else:
         return outline[i1:len(outline)] + outline[0:i2]
     
-def getFullOutline(outline):
+#withSegments also returns, for every pixel, the index of the segment (outline[i] to outline[i+1]) it was drawn from
+def getFullOutline(outline, withSegments = False):
     '''
     THIS IS NOT AN ORDERED LISTING!!!!
     '''
     fullOutline = []
+    segments = []
     for i in range(0, len(outline)):
         x1 = outline[i][0]
         y1 = outline[i][1]
@@ -609,24 +1085,31 @@ def getFullOutline(outline):
             myx = (y2-y1)/(x2-x1)
             by = y1 - myx*x1
             fullOutline.append((x1,y1))
+            segments.append(i)
             for x0 in range(min(x1*10, x2*10), max(x1*10, x2*10)):
                 x = x0/10
     #                 print(x, m*x+b)
                 if (int(x), int(myx*x+by)) != fullOutline[len(fullOutline)-1]:
                     fullOutline.append((int(x), int(myx*x+by)))
+                    segments.append(i)
         if (y2-y1) != 0:
             # y is dependent
             mxy = (x2-x1)/(y2-y1)
             bx = x1 - mxy*y1
             fullOutline.append((x1,y1))
+            segments.append(i)
             for y0 in range(min(y1*10, y2*10), max(y1*10, y2*10)):
                 y = y0/10
     #                 print(x, m*x+b)
                 if (int(mxy*y+bx), int(y)) != fullOutline[len(fullOutline)-1]:
                     fullOutline.append((int(mxy*y+bx), int(y)))
+                    segments.append(i)
 
+    if withSegments:
+        return fullOutline, segments
     return fullOutline
 
+#average of the (2r+1)x(2r+1) window of matrix centered on p.
 def getNearbyAvg(matrix, p, r):
     if r != int(r):
         raise Exception("input r must be an integer")
@@ -650,24 +1133,53 @@ def getNearbyAvg(matrix, p, r):
 # print(getTheta(v1), getTheta(v2), getTheta(v2) - getTheta(v1))#, cos(getTheta(v2) - getTheta(v1)), dot(v1,v2)/(1*sqrt(2)))
 # print(1/0)
 
+class GridIndex:
+    '''
+    The points of data bucketed into a grid of eps x eps cells, so that everything within eps of a point is
+    in the 3 x 3 cells around it, and regionQuery only has to look through those instead of all of data.
+    '''
+    def __init__(self, data, eps):
+        self.data = data
+        self.eps = eps
+        self.cells = {}
+        for n in range(0, len(data)):
+            self.cells.setdefault(self.getCell(data[n]), []).append(n)
+    
+    def getCell(self, p):
+        return (int(p[0] // self.eps), int(p[1] // self.eps))
+    
+    # the points of data within eps of P, other than P itself, in the order they're in data
+    def query(self, P):
+        cellX, cellY = self.getCell(P)
+        epsSqr = self.eps**2
+        found = []
+        for i in range(cellX - 1, cellX + 2):
+            for j in range(cellY - 1, cellY + 2):
+                for n in self.cells.get((i, j), ()):
+                    if (P != self.data[n]) and (sqrDist(self.data[n], P) < epsSqr):
+                        found.append(n)
+        found.sort()
+        return [ self.data[n] for n in found ]
+
 def getClusters(data, eps):
+    index = GridIndex(data, eps)
     clusters = []
+    # every point that's in a cluster already
+    clustered = set()
     for p1 in data:
-        skip = False
-        for c in clusters:
-            if c.__contains__(p1):
-                skip = True
-                break
-        if skip:
+        if p1 in clustered:
             continue
         c = []
         c.append(p1)
+        members = set(c)
         for p2 in c:
-            nearby = regionQuery(data, p2, eps)
+            nearby = regionQuery(data, p2, eps, index)
             for p3 in nearby:
-                if not c.__contains__(p3):
+                if p3 not in members:
                     c.append(p3)
+                    members.add(p3)
         clusters.append(c)
+        clustered.update(members)
     return clusters
         
 # 
@@ -708,7 +1220,10 @@ def getClusters(data, eps):
 #                 Clusters[len(Clusters)-1].append(P0)
 #     return Clusters
  
-def regionQuery(Data, P, eps):
+#the points of Data within eps of P. With a GridIndex of Data, only the points near P are looked at.
+def regionQuery(Data, P, eps, index = None):
+    if index is not None:
+        return index.query(P)
     nearby = []
     epsSqr = eps**2
     for p0 in Data:
@@ -750,7 +1265,102 @@ def regionQuery(Data, P, eps):
 # im.show()
 # print(1/0)
 
-def splitOutline(im, outline, outputIm1 = 0,  outputIm2 = 0 ):
+#reads walls[p], raising for points off the image like PIL's pixel access does, instead of wrapping around
+def isWall(walls, p):
+    if p[0] < 0 or p[1] < 0:
+        raise IndexError("point is off the image")
+    return walls[p]
+
+#the squared distance from each of points (an (xs, ys) pair of arrays) to the nearest of features, in an int array
+#of size (w, h) that's 0 everywhere else. An exact Euclidean distance transform over the box around them finds the nearest feature to every
+#pixel in one pass, and the squared distance to it is worked out from its coordinates, so the values are the same
+#as checking every point against every feature.
+def getSqrDistMatrix( w, h, points, features ):
+    pointXs, pointYs = points
+    featureXs = numpy.array([ p[0] for p in features ])
+    featureYs = numpy.array([ p[1] for p in features ])
+    x0 = min(pointXs.min(), featureXs.min())
+    y0 = min(pointYs.min(), featureYs.min())
+    x1 = max(pointXs.max(), featureXs.max())
+    y1 = max(pointYs.max(), featureYs.max())
+    
+    # the transform measures the distance to the nearest zero
+    notFeature = numpy.ones((x1 - x0 + 1, y1 - y0 + 1), dtype=bool)
+    notFeature[featureXs - x0, featureYs - y0] = False
+    nearestX, nearestY = distance_transform_edt(notFeature, return_distances = False, return_indices = True)
+    
+    dx = pointXs - x0 - nearestX[pointXs - x0, pointYs - y0]
+    dy = pointYs - y0 - nearestY[pointXs - x0, pointYs - y0]
+    distMatrix = zeros((w, h), dtype=int)
+    distMatrix[pointXs, pointYs] = dx*dx + dy*dy
+    return distMatrix
+
+#the points a breadth first flood fill of walls (a boolean array) from start visits, as an (xs, ys) pair of arrays in
+#the order it visits them. each ring of the fill is found at once from the one before, keeping the first time each
+#point is reached, parent by parent and then in the order of steps, so the order is the same as going point by point
+#through a queue. every point is marked in walls as it's added, except start, which gets added again from its first
+#neighbour.
+#bounds (x0, y0, x1, y1) are exclusive limits a step toward them can't reach; without them, a step off walls
+#raises an IndexError.
+def getFloodFill( walls, start, steps, bounds = None ):
+    w, h = walls.shape
+    stepXs = numpy.array([ step[0] for step in steps ])
+    stepYs = numpy.array([ step[1] for step in steps ])
+    xs = numpy.array([start[0]])
+    ys = numpy.array([start[1]])
+    ringXs = [xs]
+    ringYs = [ys]
+    while len(xs) > 0:
+        nextXs = (xs[:, numpy.newaxis] + stepXs).ravel()
+        nextYs = (ys[:, numpy.newaxis] + stepYs).ravel()
+        if bounds is not None:
+            dx = numpy.tile(stepXs, len(xs))
+            dy = numpy.tile(stepYs, len(ys))
+            keep = ~( ((dx < 0) & (nextXs <= bounds[0])) | ((dy < 0) & (nextYs <= bounds[1]))
+                    | ((dx > 0) & (nextXs >= bounds[2])) | ((dy > 0) & (nextYs >= bounds[3])) )
+            nextXs = nextXs[keep]
+            nextYs = nextYs[keep]
+        elif len(nextXs) > 0 and (nextXs.min() < 0 or nextYs.min() < 0 or nextXs.max() >= w or nextYs.max() >= h):
+            raise IndexError("flood fill went off the array")
+        
+        free = ~walls[nextXs, nextYs]
+        nextXs = nextXs[free]
+        nextYs = nextYs[free]
+        first = numpy.sort(numpy.unique(nextXs * h + nextYs, return_index = True)[1])
+        xs = nextXs[first]
+        ys = nextYs[first]
+        walls[xs, ys] = True
+        ringXs.append(xs)
+        ringYs.append(ys)
+    return numpy.concatenate(ringXs), numpy.concatenate(ringYs)
+
+#the middles of the fibers in a distance matrix (see getSqrDistMatrix), found all at once: the points of shape (an
+#(xs, ys) pair of arrays, like getFloodFill gives) where
+#the average distance over the (2r+1) x (2r+1) square around them is the largest in the size x size square around
+#them, and at least threshold times the largest average anywhere in shape. returns the points, strongest first,
+#along with their averages.
+def getDistanceMaxima( distMatrix, shape, r, size, threshold ):
+    inShape = numpy.zeros(distMatrix.shape, dtype=bool)
+    inShape[shape] = True
+    smoothed = uniform_filter(distMatrix.astype(float), size = 2*r + 1, mode = 'constant')
+    peaks = inShape & (smoothed == maximum_filter(smoothed, size = size, mode = 'constant'))
+    peaks &= smoothed >= threshold * smoothed[inShape].max()
+    xs, ys = numpy.nonzero(peaks)
+    strengths = smoothed[xs, ys]
+    order = numpy.argsort(-strengths, kind = 'stable')
+    return [ (int(xs[n]), int(ys[n])) for n in order ], strengths[order]
+
+#colors the points (xs, ys) on a debug canvas (a uint8 [x, y, channel] array) all at once, leaving out any that are off it
+def markPoints( canvas, xs, ys, color, dx = 0, dy = 0 ):
+    xs = numpy.asarray(xs, dtype=int) + dx
+    ys = numpy.asarray(ys, dtype=int) + dy
+    inside = (xs >= 0) & (ys >= 0) & (xs < canvas.shape[0]) & (ys < canvas.shape[1])
+    canvas[xs[inside], ys[inside]] = color
+
+#offset is where im's top left corner is, in the coordinates of outline
+#outputIm1 is the debug canvas, a uint8 [x, y, channel] array in the coordinates of outline that the flood fills,
+#the distance matrix and the minima get drawn on. Without one (the default), none of it is drawn.
+def splitOutline(im, outline, outputIm1 = None,  outputIm2 = 0, offset = (0,0) ):
     print("Entered splitOutline")
 #     outline = [
 #                (14,5),
@@ -819,24 +1429,9 @@ def splitOutline(im, outline, outputIm1 = 0,  outputIm2 = 0 ):
 
     # new attempt, using watershed
     
-    im0 = im.copy()
-    im1 = im.copy()
-    pixels0 = im0.load()
-    w,h = im.size
-    
-    if outputIm1 == 0:
-        outputIm1 = Image.new("RGB", (w, h), (0,0,0))
-    if outputIm2 == 0:
-        outputIm2 = Image.new("RGB", (w, h), (0,0,0))
-    
-    out1Pixels = outputIm1.load()
-        
-    tracedOutline = getFullOutline(outline)
-    
-    for i1 in range(0, len(tracedOutline)):
-        im0.putpixel(tracedOutline[i1], (255,0,0))
-    for i1 in range(0, len(outline)):
-        im1.putpixel(outline[i1], (255,0,0))
+    w = im.size[0] + 2*offset[0]
+    h = im.size[1] + 2*offset[1]
+    tracedOutline, tracedSegments = getFullOutline(outline, True)
     
     interiorPoint = 'bad point'
     
@@ -881,40 +1476,50 @@ def splitOutline(im, outline, outputIm1 = 0,  outputIm2 = 0 ):
         print("Found an outline running entire length of image. Can't split it.")
         return []
     
+    # everything from here on works in a crop of the image around the outline, with (x0, y0) as its corner.
+    # it covers the bounds of the first flood fill, and far enough around the outline for the minima search.
+    # the first flood fill starts in the middle of xMin..xMax and yMin..yMax, which can be outside all of that
+    # when the outline only ever goes one way (xMax or yMax is left at 0 then), so it's covered too.
+    sqrW = 12
+    margin = int(2.5*sqrW) + 1
+    tracedXs = [ p[0] for p in tracedOutline ]
+    tracedYs = [ p[1] for p in tracedOutline ]
+    centerX = int((xMax+xMin)/2)
+    centerY = int((yMax+yMin)/2)
+    x0 = max(min(lBnd, min(tracedXs) - margin, centerX), 0)
+    y0 = max(min(dwBnd, min(tracedYs) - margin, centerY), 0)
+    x1 = min(max(rBnd, max(tracedXs) + margin, centerX), w - 1)
+    y1 = min(max(upBnd, max(tracedYs) + margin, centerY), h - 1)
+    
+    # the flood fills below stop at pure red pixels, and at the outline; they mark a boolean array instead of painting
+    walls = numpy.all(numpy.asarray(im.crop((x0 - offset[0], y0 - offset[1], x1 + 1 - offset[0], y1 + 1 - offset[1]))) == (255,0,0), axis=2).T
+    w = x1 + 1 - x0
+    h = y1 + 1 - y0
+    
+    debug = outputIm1 is not None
+    
+    fullOutline = outline
+    outline = [ (p[0] - x0, p[1] - y0) for p in outline ]
+    tracedOutline = [ (p[0] - x0, p[1] - y0) for p in tracedOutline ]
+    for i1 in range(0, len(tracedOutline)):
+        walls[tracedOutline[i1]] = True
+    lBnd -= x0
+    rBnd -= x0
+    dwBnd -= y0
+    upBnd -= y0
+    xMin -= x0
+    xMax -= x0
+    yMin -= y0
+    yMax -= y0
+    
 #     pointsIncludingCenter.append((lBnd + 2, dwBnd+2))
     pointsIncludingCenter.append((int((xMax+xMin)/2), int((yMax+yMin)/2)))
-    i = 0
-    try:
-        print("initial point: ", pointsIncludingCenter[i])
-        while i < len(pointsIncludingCenter):
-            outputIm1.putpixel(pointsIncludingCenter[i], (0,255,255))
-            right = (pointsIncludingCenter[i][0] + 1, pointsIncludingCenter[i][1])
-            left = (pointsIncludingCenter[i][0] - 1, pointsIncludingCenter[i][1])
-            up = (pointsIncludingCenter[i][0], pointsIncludingCenter[i][1] + 1)
-            down = (pointsIncludingCenter[i][0], pointsIncludingCenter[i][1] - 1)
-#             print(pointsIncludingCenter[i], "|", right, rBnd, (right[0] < rBnd),"|", left, lBnd, (left[0] > lBnd),"|", up, upBnd, (up[0] < upBnd),"|", down, dwBnd, (down[0] > dwBnd))
-            
-            if (right[0] < rBnd) and (pixels0[right] != (255,0,0)):
-                pointsIncludingCenter.append(right)
-                im0.putpixel(right, (255,0,0))
-                
-            if (left[0] > lBnd) and (pixels0[left] != (255,0,0)):
-                pointsIncludingCenter.append(left)
-                im0.putpixel(left, (255,0,0))
-                
-            if (up[1] < upBnd) and (pixels0[up] != (255,0,0)):
-                pointsIncludingCenter.append(up)
-                im0.putpixel(up, (255,0,0))
-                
-            if (down[1] > dwBnd) and (pixels0[down] != (255,0,0)):
-                pointsIncludingCenter.append(down)
-                im0.putpixel(down, (255,0,0))
-            i += 1
-    except Exception:
-        im0.show()
-        raise
+    print("initial point: ", pointsIncludingCenter[0])
+    # right, left, up and down, staying inside the bounds
+    pointsIncludingCenter = getFloodFill(walls, pointsIncludingCenter[0], ((1,0), (-1,0), (0,1), (0,-1)), (lBnd, dwBnd, rBnd, upBnd))
+    i = len(pointsIncludingCenter[0])
     
-    shape = []
+    shape = (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int))
     
     areaSquareEnclosingOutline = (xMax-xMin)*2 * (yMax-yMin)*2
 #     if outline[0] == (77, 25):
@@ -934,41 +1539,15 @@ def splitOutline(im, outline, outputIm1 = 0,  outputIm2 = 0 ):
 #             v1 = getVector(cur, nxt)
 #             v2 = getVector(nxt, nxtnxt)
             avg = ( (cur[0] + nxt[0] + nxtnxt[0])/3, (cur[1] + nxt[1] + nxtnxt[1])/3 )
-            if pixels0[avg] != (255,0,0):
+            if not isWall(walls, (int(avg[0]), int(avg[1]))):
                 interiorPoint = ( int((cur[0]+nxtnxt[0])/2), int((cur[1]+nxtnxt[1])/2) )
 #                 im1.putpixel(cur, (0,0,255))
 #                 im1.putpixel(nxt, (0,128,255))
 #                 im1.putpixel(nxtnxt, (0,255,255))
                 print("insidePoint:",cur,nxt,nxtnxt,interiorPoint)
-                shape.append(interiorPoint)
-                i = 0
-                
                 try:
-                    while i < len(shape):
-                        outputIm1.putpixel(shape[i], (0,255,255))
-                        right = (shape[i][0] + 1, shape[i][1])
-                        if pixels0[right] != (255,0,0):
-                            shape.append(right)
-                            im0.putpixel(right, (255,0,0))
-                            
-                        left = (shape[i][0] - 1, shape[i][1])
-                        if pixels0[left] != (255,0,0):
-                            shape.append(left)
-                            im0.putpixel(left, (255,0,0))
-                            
-                        up = (shape[i][0], shape[i][1] - 1)
-                        if pixels0[up] != (255,0,0):
-                            shape.append(up)
-                            im0.putpixel(up, (255,0,0))
-                            
-                        down = (shape[i][0], shape[i][1] + 1)
-                        if pixels0[down] != (255,0,0):
-                            shape.append(down)
-                            im0.putpixel(down, (255,0,0))
-                            
-                        i += 1
-                        
-                except Exception:
+                    shape = getFloodFill(walls, interiorPoint, ((1,0), (-1,0), (0,-1), (0,1)))
+                except IndexError:
 #                     shape = []
 #                     im0 = im.copy()
 #                     im1 = im.copy()
@@ -979,15 +1558,6 @@ def splitOutline(im, outline, outputIm1 = 0,  outputIm2 = 0 ):
 #                         im1.putpixel(outline[i1], (255,0,0))
 #                     continue
                     return splitList
-                    outputIm1.show()
-                    im0.show()
-#                     im0.save("crap.bmp")
-                    im1.show()
-                    print("\n\nIn shape flood-fill exception", i, shape[i])
-                    splitList.append(outline)
-                    return 1/0
-#                     raise
-                    return splitList
                 break
                 
 #                 if nxt[0] == cur[0] or nxtnxt[0] == nxt[0]:
@@ -1001,154 +1571,95 @@ def splitOutline(im, outline, outputIm1 = 0,  outputIm2 = 0 ):
     
     if interiorPoint == 'bad point':
         return splitList
+    if debug:
+        markPoints(outputIm1, shape[0], shape[1], (0,255,255), x0, y0)
 #     im0.show()
 #     im0.save("borderedThingy.bmp")
     
     
     #populate distance matrix
-    distMatrix = array([[0]*h]*w)
-    for p in shape:
-        minSqrdDist = w*w
-        for o in tracedOutline:
-            dist = sqrDist(p, o)
-            if dist < minSqrdDist:
-                minSqrdDist = dist
-        distMatrix[p[0]][p[1]] = minSqrdDist
-    
-    if False != True:
+    distMatrix = getSqrDistMatrix(w, h, shape, tracedOutline)
+    
+    if debug:
 #         im2 = Image.new("RGB", (w,h), (0,0,0))
-        maxDist = 0
-        maxDist = 0
-        minDist = w*w
-        for x in range(0, w):
-            for y in range(0, h):
-                if distMatrix[x][y] > maxDist:
-                    maxDist = distMatrix[x][y]
-                elif distMatrix[x][y] < minDist:
-                    minDist = distMatrix[x][y]
+        # distMatrix only covers the crop around the outline, so this scales with the fiber, not the image
+        maxDist = int(distMatrix.max())
+        minDist = min(int(distMatrix.min()), w*w)
+        
+        scale = 255/(maxDist - minDist) if maxDist > minDist else 0
         
-        scale = 255/(maxDist - minDist)
-
-        for x in range(0, w):
-            for y in range(0, h):
-                c = int(scale * distMatrix[x][y])
-                c1 = out1Pixels[(x,y)][0]
-                if c > c1:
-                    outputIm1.putpixel((x,y), (c,c,c))
+        # the distances in gray, over whatever is darker in the debug canvas
+        c = numpy.clip(scale * distMatrix, 0, 255).astype(numpy.uint8)
+        region = outputIm1[x0:x0 + w, y0:y0 + h]
+        brighter = c > region[:, :, 0]
+        region[brighter] = c[brighter][:, numpy.newaxis]
                 
 #         outputIm2.show()
 #         outputIm2.save("pretty.bmp")
     
     # find minima
-    allMinima = []
-    sqrW = 12
-    
     print("Finding minima")
-    for i in range(0, len(shape), 10*sqrW):
-        bestP = shape[i]
-        
-        for cutoff in range(0, int(sqrt(len(shape)))):
-            currentP = bestP
-#             minimaPathTrace.putpixel(currentP, (255,0,0))
-            
-            best = getNearbyAvg(distMatrix, currentP, int(sqrW/2))
-            for i1 in range(-1,2):
-                for i2 in range(-1,2):
-                    if i1 == 0 and i2 == 0:
-                        continue
-                    avg = getNearbyAvg(distMatrix, (bestP[0] + i1*sqrW, bestP[1] + i2*sqrW), int(sqrW/2))
-                    if avg > best:
-                        bestP = (bestP[0] + i1*sqrW, bestP[1] + i2*sqrW)
-                        best = avg
-            if bestP == currentP:
-                break
-        
-#         dontAdd = False
-#         for m in minima:
-#             if sqrDist(bestP, m) < 2*sqrW:
-#                 dontAdd = True
-#                 break
-#         if not dontAdd:
-        allMinima.append(bestP)
-        
-#             minimaPathTrace.putpixel(currentP, (0,0,255))
-#     minimaPathTrace.show()
-#     outputIm1.show()
+    allMinima, strengths = getDistanceMaxima(distMatrix, shape, int(sqrW/2), 2*sqrW + 1, 0.1)
     
     # now clustering algorithm, to average together all points which are within some small distance of each other.
     # Groups a, b, and c if aRb and bRc, even if not aRc.
+    # each cluster's middle is weighted toward its strongest maxima
     clusters = getClusters(allMinima, 20)
+    strengthOf = dict(zip(allMinima, strengths))
     minima = []
     for c in clusters:
         totX = 0
         totY = 0
+        tot = 0
         for p in c:
-            totX += p[0]
-            totY += p[1]
-        minima.append((int(totX/len(c)),int(totY/len(c))))
+            totX += p[0] * strengthOf[p]
+            totY += p[1] * strengthOf[p]
+            tot += strengthOf[p]
+        # a cluster with no strength at all (the distances are all zero) gets its plain middle
+        if tot == 0:
+            for p in c:
+                totX += p[0]
+                totY += p[1]
+            tot = len(c)
+        minima.append((int(totX/tot),int(totY/tot)))
 #     minima = allMinima
-    for m in allMinima:
-        try:
-            outputIm1.putpixel(m, (255,255,0))
-        except Exception:
-            ()
-    for m in minima:
-        try:
-            outputIm1.putpixel(m, (255,0,0))
-        except Exception:
-            ()
+    if debug:
+        markPoints(outputIm1, [ p[0] for p in allMinima ], [ p[1] for p in allMinima ], (255,255,0), x0, y0)
+        markPoints(outputIm1, [ p[0] for p in minima ], [ p[1] for p in minima ], (255,0,0), x0, y0)
         
     
     breakPoints = []
     print("minima", minima)
     if len(minima) > 2:
-        for i4 in range(0, len(tracedOutline)):
-            p = tracedOutline[i4]
-            # find the closest two minima
-            min1 = (0,0)
-            min1Dist = w*w
-            min2 = (0,0)
-            min2Dist = w*w
-            for m in minima:
-                dist = sqrDist(p, m)
-                if dist < min2Dist:
-                    if dist < min1Dist:
-                        min2Dist = min1Dist
-                        min2 = min1
-                        min1Dist = dist
-                        min1 = m
-                    else:
-                        min2Dist = dist
-                        min2 = m
-    #         print(p, abs(sqrDist(p, min1) - sqrDist(p, min2)))
-            if abs(sqrDist(p, min1) - sqrDist(p, min2)) < 60:
-#                 print(p, "###############################")
-                # p is a breakpoint, find nearest points in outline
-                for i in range(0, len(outline)):
-                    # if p is between (in both x and y directions) the current point and the next one
-                    prv = outline[i]
-                    nxt = outline[(i+1)%len(outline)]
-                    if (    p[0] >= min(prv[0], nxt[0]) 
-                        and p[0] <= max(prv[0], nxt[0])
-                        and p[1] >= min(prv[1], nxt[1]) 
-                        and p[1] <= max(prv[1], nxt[1])):
-                        isContained = False
-                        for i1 in range(0, len(breakPoints)):
-                            if abs(breakPoints[i1] - i) < 10:
-                                isContained = True
-                                break
-                        if not isContained:
-                            breakPoints.append(i)
+        # the two closest minima to every pixel of the outline at once
+        tracedPoints = numpy.array(tracedOutline)
+        minimaPoints = numpy.array(minima)
+        nearest = cKDTree(minimaPoints).query(tracedPoints, k = 2)[1]
+        dist1 = ((tracedPoints - minimaPoints[nearest[:, 0]])**2).sum(axis=1)
+        dist2 = ((tracedPoints - minimaPoints[nearest[:, 1]])**2).sum(axis=1)
+        # the segments already broken at
+        broken = set()
+        # pixels about as close to two minima are where the outline should break, at the segment they were drawn from
+        for i4 in numpy.nonzero(numpy.abs(dist1 - dist2) < 60)[0]:
+            i = tracedSegments[i4]
+            isContained = False
+            for i1 in range(i - 9, i + 10):
+                if i1 in broken:
+                    isContained = True
+                    break
+            if not isContained:
+                breakPoints.append(i)
+                broken.add(i)
 #     print("___________________________________",breakPoints)
                 
     if len(breakPoints) == 0:
-        splitList.append(outline)
+        splitList.append(fullOutline)
         return splitList
     
     for i1 in range(0, len(breakPoints)):
         if abs(breakPoints[i1]+1 - breakPoints[(i1-1)%len(breakPoints)]) > 0:
 #             splitList.append(outline[bP[i-1]:bP[i]])
-            splitList.append(getSlice(outline, breakPoints[(i1-1)%len(breakPoints)], breakPoints[i1]+1))
+            splitList.append(getSlice(fullOutline, breakPoints[(i1-1)%len(breakPoints)], breakPoints[i1]+1))
 #     if outputIm2 != 0:
 #         for i2 in range(0, len(splitList)):
 #             drawPerimeter(splitList[i2], outputIm2, (0,255,0))
@@ -1198,11 +1709,14 @@ def fillOutline( outline, image, col ):
     draw.polygon(tuple(outline), col)
     
 def drawOutline( outline, image):
+    w, h = image.size
     for i in range(0, len(outline)):
         c1 = int(255 * (1- i/len(outline)))
         c2 = int(255 * (i/len(outline)))
         hue = (c1,c2,0)
-        image.putpixel(outline[i], hue)
+        # points out in the border don't get drawn
+        if 0 <= outline[i][0] < w and 0 <= outline[i][1] < h:
+            image.putpixel(outline[i], hue)
 
 def solve(data, minW):
     try:
@@ -1238,22 +1752,24 @@ def solve(data, minW):
 def getRect(pixels, x, y, w, h):
     return pixels[x:x+w,y:y+h]
 
+#returns the stdev and average of each channel in box.
 def getRegionalStats(box):
-    colorCount = [0,0,0]
+    channels = len(box[0][0])
+    colorCount = [0] * channels
     boxes = 0
     
     for i in range(0,len(box)):
         for j in range(0,len(box[i])):
-            for c in range(0,3):
+            for c in range(0,channels):
                 colorCount[c] += box[i][j][c]
             boxes += 1
     
-    for i in range(0, 3):
+    for i in range(0, channels):
         colorCount[i] /= boxes
     
     stdev=[]
     
-    for c in range(0,3):
+    for c in range(0,channels):
         stdev.append(0)
         for i in range(0,len(box)):
             for j in range(0,len(box[i])):
@@ -1325,7 +1841,326 @@ def loadData(fileName):
 # print(l)
 # print(1/0)
 
-def standAlone( imPath, minWidth ):
+# orientationMode picks how the edge angle and contrast are found at each point:
+#    'bisect' - the half-plane binary search of getBestAngle (the original, exact method)
+#    'tensor' - looked up from a StructureTensorField computed once for the whole image. Much faster,
+#               but it's a gradient estimate, so it doesn't reproduce the half-plane results exactly.
+#the pieces of the detector that standAlone (or each of its tiles) builds once: the StructureTensorField for
+#orientationMode 'tensor' (None for 'bisect'), a CheckPointCache of cacheSize results (None if it's not used)
+#and the Pyramid for traceMode 'pyramid' (None for 'direct')
+def getDetector( pixels, boxW, orientationMode, cacheSize, traceMode = 'direct' ):
+    if orientationMode == 'tensor':
+        print("Computing structure tensor...")
+        field = StructureTensorField(numpy.asarray(pixels).transpose(1, 0, 2), boxW)
+    elif orientationMode == 'bisect':
+        field = None
+    else:
+        raise Exception("unknown orientationMode: " + str(orientationMode))
+    
+    # with the structure tensor, checkPoint is already just a lookup
+    cache = None
+    if cacheSize > 0 and field is None:
+        cache = CheckPointCache(cacheSize)
+    
+    if traceMode == 'pyramid':
+        pyramid = Pyramid(pixels, boxW, cacheSize = cacheSize)
+    elif traceMode == 'direct':
+        pyramid = None
+    else:
+        raise Exception("unknown traceMode: " + str(traceMode))
+    return field, cache, pyramid
+
+#the scan part of standAlone: traces every fiber it can find, starting from the grid points gridX x gridY.
+#pixels is the pixel array of the padded image (a PaddedPixels, or an ndarray), and im is a PIL copy of the image
+#whose top left corner is at imOffset in it. Outlines are drawn on im, and traced fibers are filled in on pixels
+#so they don't get found again.
+#yields each fiber's outline along with its split outlines as soon as it's been traced and split.
+#the first fiber isn't filled in on pixels, so it can be found a second time; fillFirst fills it in like the rest.
+#labels is an int raster the size of pixels (made here if it's None). The inside of the nth fiber found is labelled
+#n, and grid points that are already inside a fiber aren't started from.
+#with a Pyramid, outlines are traced coarse to fine with getPyramidOutline.
+#with an AdaptiveStep as stepper (see getStepper), getOutline changes its step with the curvature of the edge.
+#candidateOrder is the order the candidate map is visited in, see getCandidateMap.
+#withStarts also yields the grid point each fiber was started from and its candidate map strength (None without the
+#map), which is where it comes in the scan.
+def traceFibers( im, pixels, boxW, gridX, gridY, maxLength, avg, stdev, fillCol, axis = None, field = None,
+                 cache = None, useCandidateMap = True, outputIm1 = None, fillFirst = False, labels = None, pyramid = None,
+                 imOffset = (0,0), stepper = None, candidateOrder = 'raster', withStarts = False ):
+    width, height = pixels.shape[:2]
+    # fillCol as it reads in the pixel array
+    fillValue = getPixelArray(Image.new("RGB", (1,1), fillCol), axis)[0,0]
+    if labels is None:
+        labels = numpy.zeros((width, height), dtype=numpy.int32)
+    skipSize = int(boxW / 2)
+    
+    #the tolerances for picking a "good" point
+    highContrast = [ 2*x/8 for x in stdev ]
+    midContrast = [ 5*x/32 for x in stdev ]
+    lowContrast = [ x/8 for x in stdev ]
+    
+    if useCandidateMap:
+        print("Building candidate map...")
+        candidates, strengths = getCandidateMap(pixels, boxW, gridX, gridY, midContrast, field, order = candidateOrder,
+                                                withStrengths = True)
+        print(len(candidates), "candidates out of", len(gridX)*len(gridY), "grid points")
+    else:
+        candidates = [ (i, j) for j in gridY for i in gridX ]
+        strengths = [None] * len(candidates)
+    
+    found = 0
+    # marks the area around every fiber that has been filled in on pixels since the candidate map was made
+    stale = numpy.zeros((width, height), dtype=bool)
+     
+    for (i, j), strength in zip(candidates, strengths):
+        '''
+        1. check point
+        2. if point is good, try to trace outline
+        3. if there are enough points in the outline, add it to the list
+        '''
+        #test on 401x302
+        #took about 5.5 mins, most of which felt like the continuous loops
+        
+        if labels[i][j] != 0:
+            continue
+        
+        # candidates already passed sqrOk and checkPoint, unless a fiber was filled in over them since
+        if (not useCandidateMap) or stale[i][j]:
+            square = getSquare(pixels, boxW, i, j)
+#             print('\nBegininng of standAlone loop',i,j)
+            #first examine the square to see if it's worth calculating
+            if not sqrOk(square, avg, midContrast):
+                continue
+            
+            #the first result, theta, is ignored here
+            if cache is not None:
+                diff = cache.checkPoint(pixels, boxW, i, j, field)[1]
+            else:
+                diff = checkPoint(square, field, (i, j))[1]
+            if not absBiggerThan(diff, midContrast):
+                continue
+ 
+#         print('Right before getBestInRegion',i,j)
+        p,t,d = getBestInRegion(pixels, width, height, boxW, i, j, int(skipSize/2), skipSize, 'n', avg, lowContrast, field, cache)
+#         print('\tRight after getBestInRegion',p)
+ 
+        if absBiggerThan(d, highContrast):
+#             print('Right before getOutline',p)
+            if pyramid is None:
+                outline = getOutline(pixels, width, height, boxW, maxLength, p[0], p[1], avg, stdev, field, cache, stepper = stepper)
+            else:
+                outline = getPyramidOutline(pixels, pyramid, width, height, boxW, maxLength, p[0], p[1], avg, stdev, field, cache, stepper)
+#             print('t',i,j)
+#             drawOutline(outline, im)
+#             im.show()
+#             return
+            if len(outline) < 7 or getNetDeltaAngle(outline, 0, 0, len(outline)) > 0:
+                continue
+            
+#             if outline[0] != (77, 25):
+#                 continue
+            
+            # split the outline here, before you fill it in.
+#             splitOutlines = splitOutline( im, outline, outputIm1, outputIm2 )
+            splitOutlines = splitOutline( im, outline, outputIm1, offset = imOffset )
+            
+            print("First point in splitOutline: ", outline[0])
+            print("len: ", len(splitOutlines))
+#             fillOutline(outline, im, fillCol)
+#             drawOutline(outline, im)
+#             im.show()
+#             im3 = im.copy()
+#             drawOutline(outline, im3)
+#             im3.show()
+#             return
+            
+            if found > 0 or fillFirst:
+                changed, cx0, cy0 = fillPixels(pixels, outline, fillValue)
+                xs = [ q[0] for q in outline ]
+                ys = [ q[1] for q in outline ]
+                if pyramid is not None:
+                    pyramid.refresh(pixels, min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+                if cache is not None:
+                    cache.invalidate(cx0, cy0, cx0 + changed.shape[0], cy0 + changed.shape[1], boxW, changed)
+                if field is not None:
+                    field.refresh(pixels, min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+                stale[max(min(xs) - boxW, 0):max(xs) + boxW + 1, max(min(ys) - boxW, 0):max(ys) + boxW + 1] = True
+            if splitOutlines == []:
+                continue
+#             splitOutlines = splitOutline( im, outline )
+            found += 1
+            labelOutline(labels, outline, found)
+            print("SplitOutline Appended.\n")
+            
+            fillOutline(shiftOutline(outline, -imOffset[0], -imOffset[1]), im, fillCol)
+            drawOutline(shiftOutline(outline, -imOffset[0], -imOffset[1]), im)
+            if withStarts:
+                yield outline, splitOutlines, (i, j), strength
+            else:
+                yield outline, splitOutlines
+#             im3 = im.copy()
+#             drawOutline(outline, im3)
+#             im3.show()
+#             im.show()
+#             return
+ 
+#         print( "\r{0:.3f}% checked".format( (float((j * (width-boxW) + i) * 100)/((height-boxW) * (width-boxW)))  ) )
+ 
+    print("100% checked")
+    if cache is not None:
+        print(cache)
+    if stepper is not None:
+        print(stepper)
+
+#what each worker runs in tile mode: traceFibers on one tile. pixels is the tile's crop of the padded pixel
+#array and rgb the same crop of the image, halo included, and (x0, y0) is where their top left corner is.
+#returns, for every fiber that was found, where it comes in a single run's scan (see getScanKey), the grid point it
+#was started from, its outline and its split outlines, all in the coordinates of the whole padded image.
+def traceTile( pixels, rgb, x0, y0, gridX, gridY, boxW, maxLength, avg, stdev, fillCol, axis, orientationMode, cacheSize, useCandidateMap,
+               traceMode = 'direct', stepMode = 'fixed', minStep = None, maxStep = None, candidateOrder = 'raster' ):
+    im = Image.fromarray(rgb)
+    field, cache, pyramid = getDetector(pixels, boxW, orientationMode, cacheSize, traceMode)
+    stepper = getStepper(stepMode, minStep, maxStep)
+    gridX = [ x - x0 for x in gridX ]
+    gridY = [ y - y0 for y in gridY ]
+    
+    results = []
+    for outline, splitOutlines, start, strength in traceFibers(im, pixels, boxW, gridX, gridY, maxLength, avg, stdev, fillCol,
+                                                               axis = axis, field = field, cache = cache,
+                                                               useCandidateMap = useCandidateMap, pyramid = pyramid,
+                                                               stepper = stepper, candidateOrder = candidateOrder,
+                                                               withStarts = True):
+        start = (start[0] + x0, start[1] + y0)
+        outline = [ (p[0] + x0, p[1] + y0) for p in outline ]
+        splitOutlines = [ [ (p[0] + x0, p[1] + y0) for p in o ] for o in splitOutlines ]
+        results.append((getScanKey(start, strength, candidateOrder), start, outline, splitOutlines))
+    return results
+
+#where a fiber started from the grid point start comes in a single run's scan, as something to sort by: the rows of
+#the grid in order, or with candidateOrder 'strongest', its candidate map strength first (see getCandidateMap)
+def getScanKey( start, strength, candidateOrder ):
+    if candidateOrder == 'strongest' and strength is not None:
+        return (-strength, start[1], start[0])
+    return (start[1], start[0])
+
+#the tiles traceInTiles hands out, one at a time: each tile's crop of the padded pixel array and of the image, halo
+#included, the corner (x0, y0) of the crop, and the grid points in the tile
+def getTiles( im, pixels, gridX, gridY, tileSize, tileHalo, imOffset ):
+    width, height = pixels.shape[:2]
+    for ty in range(0, height, tileSize):
+        for tx in range(0, width, tileSize):
+            xs = [ x for x in gridX if tx <= x < tx + tileSize ]
+            ys = [ y for y in gridY if ty <= y < ty + tileSize ]
+            if len(xs) == 0 or len(ys) == 0:
+                continue
+            x0 = max(tx - tileHalo, 0)
+            y0 = max(ty - tileHalo, 0)
+            x1 = min(tx + tileSize + tileHalo, width)
+            y1 = min(ty + tileSize + tileHalo, height)
+            rgb = numpy.asarray(im.crop((x0 - imOffset[0], y0 - imOffset[1], x1 - imOffset[0], y1 - imOffset[1])))
+            yield numpy.array(pixels[x0:x1, y0:y1]), rgb, x0, y0, xs, ys
+
+#runs traceFibers on tiles of the padded pixel array in a pool of worker processes. im is the image, with its
+#top left corner at imOffset in pixels. The grid points are split
+#into tiles of tileSize x tileSize, and each worker gets its tile plus tileHalo pixels around it, so that a
+#fiber starting in the tile can be traced all the way around as long as it's no longer than the halo.
+#tiles are cropped as they're handed out, with at most two per worker waiting, so only those are held in memory.
+#returns the outlines and their split outlines, put back together in a single run's order by mergeTileOutlines.
+def traceInTiles( im, pixels, boxW, gridX, gridY, maxLength, avg, stdev, fillCol, axis, orientationMode, cacheSize, useCandidateMap,
+                  workers, tileSize, tileHalo, traceMode = 'direct', imOffset = (0,0), stepMode = 'fixed', minStep = None,
+                  maxStep = None, candidateOrder = 'raster' ):
+    width, height = pixels.shape[:2]
+    tileHalo = max(tileHalo, boxW)
+    
+    print("Tracing tiles with", workers, "workers")
+    tileResults = []
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        pending = {}
+        for n, (crop, rgb, x0, y0, xs, ys) in enumerate(getTiles(im, pixels, gridX, gridY, tileSize, tileHalo, imOffset)):
+            if len(pending) >= 2*workers:
+                done = wait(pending, return_when = FIRST_COMPLETED)[0]
+                for f in done:
+                    tileResults.append((pending.pop(f), f.result()))
+            future = executor.submit(traceTile, crop, rgb, x0, y0, xs, ys, boxW, maxLength, avg, stdev, fillCol,
+                                     axis = axis, orientationMode = orientationMode, cacheSize = cacheSize,
+                                     useCandidateMap = useCandidateMap, traceMode = traceMode, stepMode = stepMode,
+                                     minStep = minStep, maxStep = maxStep, candidateOrder = candidateOrder)
+            pending[future] = n
+            del crop, rgb
+        for f in as_completed(pending):
+            tileResults.append((pending[f], f.result()))
+    print("Traced", len(tileResults), "tiles")
+    
+    tileResults.sort(key = lambda r: r[0])
+    return mergeTileOutlines([ r[1] for r in tileResults ], width, height)
+
+#rasterizes the polygon outline into a boolean mask of its bounding box, the same way fillOutline fills it.
+#returns the mask, indexed [x, y], and the corner (x0, y0) of the bounding box.
+def getOutlineMask( outline ):
+    xs = [ p[0] for p in outline ]
+    ys = [ p[1] for p in outline ]
+    x0 = min(xs)
+    y0 = min(ys)
+    maskIm = Image.new("L", (max(xs) - x0 + 1, max(ys) - y0 + 1), 0)
+    ImageDraw.Draw(maskIm).polygon([ (p[0] - x0, p[1] - y0) for p in outline ], 1)
+    return numpy.asarray(maskIm, dtype=bool).T, x0, y0
+
+#labels the pixels inside outline with label, leaving pixels that already belong to another fiber alone
+def labelOutline( labels, outline, label ):
+    mask, x0, y0 = getOutlineMask(outline)
+    region = labels[x0:x0 + mask.shape[0], y0:y0 + mask.shape[1]]
+    mask = mask[:region.shape[0], :region.shape[1]]
+    region[mask & (region == 0)] = label
+
+#combines the fibers found in each tile (see traceTile) the way a single run would have found them: in the order of
+#the single run's scan, leaving out a fiber if its grid point is inside a fiber kept from another tile (a single run
+#wouldn't have started there), or if most of its area is already covered by one. A fiber that crosses a seam is found
+#from both sides of it, and only the first copy is kept. Fibers from the same tile are all kept, like they would be in
+#a single run.
+#It can't match a single run exactly: each tile only sees its own fibers filled in on the pixels and drawn for
+#splitOutline, so a tile can trace (or split) a fiber differently next to one that was found in another tile.
+def mergeTileOutlines( tileResults, width, height ):
+    fibers = []
+    for t in range(0, len(tileResults)):
+        for key, start, outline, splitOutlines in tileResults[t]:
+            fibers.append((key, t, start, outline, splitOutlines))
+    fibers.sort(key = lambda f: f[0])
+    
+    owner = numpy.full((width, height), -1, dtype=numpy.int32)
+    merged = []
+    for key, t, start, outline, splitOutlines in fibers:
+        if owner[start[0], start[1]] >= 0 and owner[start[0], start[1]] != t:
+            continue
+        mask, x0, y0 = getOutlineMask(outline)
+        region = owner[x0:x0 + mask.shape[0], y0:y0 + mask.shape[1]]
+        mask = mask[:region.shape[0], :region.shape[1]]
+        overlap = mask & (region >= 0) & (region != t)
+        if overlap.sum() > mask.sum() / 2:
+            continue
+        region[mask & (region < 0)] = t
+        merged.append((outline, splitOutlines))
+    print(len(merged), "fibers after merging tiles")
+    return merged
+
+# useCandidateMap runs sqrOk and checkPoint on the whole grid at once (getCandidateMap) and then only visits the
+# points that passed, in rows like the plain scan, or strongest first with candidateOrder 'strongest'. Without it,
+# every grid point is checked one at a time, in order.
+# cacheSize is how many checkPoint results to remember (see CheckPointCache); 0 turns the cache off.
+# channelMode 'luminance' or 'principal' runs detection and tracing on one channel, see getProjectionAxis.
+# workers > 1 splits the image into tiles and traces them in that many processes, see traceInTiles. tileHalo
+# should be at least as long as the longest fiber; by default it's 20*minWidth.
+# traceMode 'pyramid' traces each outline on a half size copy of the image first, see getPyramidOutline.
+# stepMode 'adaptive' lengthens getOutline's step from minStep up to maxStep along straight stretches of edge and
+# shortens it again where the edge curves or fades, see AdaptiveStep. The steps it saved are printed at the end.
+# detectFibers yields each ellipse (h, k, t, a, b) as soon as the fiber it belongs to is traced, split and fit.
+# withOutlines yields (ellipse, outline, fitOutline) instead: the fiber's whole outline and the piece of it that
+# the ellipse was fit to. images can be a dict, which gets the working images put in it: 'im', the image the
+# outlines are drawn on, 'outputIm1' (the debug canvas, or None), and 'labels' (see traceFibers), without the border.
+# debugDir is where to save <image name>_splits.bmp, the flood fills, distance matrices and minima that splitOutline
+# worked out for every fiber. By default it's None, and none of that is drawn. Tiles don't draw it, so with
+# workers > 1 it's ignored (with a warning) and no debug image is saved.
+def detectFibers( imPath, minWidth, orientationMode = 'bisect', useCandidateMap = True, cacheSize = 100000, channelMode = 'rgb',
+                  workers = 1, tileSize = 512, tileHalo = None, traceMode = 'direct', withOutlines = False, images = None,
+                  stepMode = 'fixed', minStep = None, maxStep = None, debugDir = None, candidateOrder = 'raster' ):
     d1 = datetime.datetime.now()
     
     # took ~2:52:10 for a 2000x4000 image, when using the 25 box checker, skipping by 2. (so 6 points? or 12?)
@@ -1349,10 +2184,8 @@ def standAlone( imPath, minWidth ):
 #     im = Image.new("RGB", (100, 100), (40,80,160))
 #     im.show()
 #     return
-    im2 = im.copy()
     
     width, height = im.size
-    out = Image.new("RGB", (width, height), (0,0,0))
     pixels = im.load()
     
     print("Image loaded.")
@@ -1365,19 +2198,25 @@ def standAlone( imPath, minWidth ):
     maxLength = width if (width > height) else height
 
     
+    if tileHalo is None:
+        tileHalo = 20*minWidth
+    
     print("Getting statistics...")
     stdev, avg = getStats(pixels, width, height)
     
-    #the tolerances for picking a "good" point
-    highContrast = [ 2*x/8 for x in stdev ]
-    midContrast = [ 5*x/32 for x in stdev ]
-    lowContrast = [ x/8 for x in stdev ]
-    
     fillCol = avg
     for i in range(0, len(fillCol)):
         fillCol[i] = int(fillCol[i] - 4*stdev[i]/7)
     fillCol = tuple(fillCol)
     
+    # in a single-channel mode, everything after this works on the image projected onto one color axis
+    axis = getProjectionAxis(im, channelMode)
+    if axis is not None:
+        print("Projecting onto color axis", axis)
+        stdev = [ float((numpy.asarray(im, dtype=float) @ axis).std()) ]
+        # avg is the same list as fillCol was, so it's projected the same way as the filled-in pixels will be
+        avg = [ float(numpy.dot(avg, axis)) ]
+    
     print("avg = ", avg)
     print("stdev = ", stdev)
     
@@ -1388,26 +2227,20 @@ def standAlone( imPath, minWidth ):
     # it'l have to be dependent on the scale of the ellipses in the image
     skipSize = int(boxW / 2)
 
-    outlineList = []
-
-    # center image on dark background
+    # center image on dark background. The background isn't made; the pixel array just reads fillCol there,
+    # and everything from here on is in the coordinates of the bordered image
     border = 2*boxW
-
-    background = Image.new('RGB', (width + 2*border, height + 2*border), fillCol)
-    bg_w, bg_h = background.size
-    offset = (int((bg_w - width) / 2), int((bg_h - height) / 2))
-    background.paste(im2, offset)
-    background.save("bordered"+imName[:len(imName)-3]+"bmp")
-#     background.show()
-#     return
-    # re-load these variables
-    im2 = background
-    im = im2.copy()
-    original = im2.copy()
-    width,height = im2.size
-    pixels = im2.load()
-    
-    outputIm1 = Image.new("RGB", (width, height), (0,0,0))
+    offset = (border, border)
+    pixels = PaddedPixels(getPixelArray(im, axis), border, getPixelArray(Image.new("RGB", (1,1), fillCol), axis)[0,0])
+    width, height = pixels.shape[:2]
+    
+    # the debug canvas splitOutline draws on, only made if it's going to be saved. Tiles don't draw on it,
+    # so there's nothing to save in tile mode.
+    outputIm1 = None
+    if debugDir is not None and workers > 1:
+        print("debugDir is ignored when tracing in tiles (workers > 1); no debug images will be saved")
+    elif debugDir is not None:
+        outputIm1 = numpy.zeros((width, height, 3), dtype=numpy.uint8)
 #     outputIm2 = Image.new("RGB", (width, height), (0,0,0))
     
     
@@ -1439,89 +2272,30 @@ def standAlone( imPath, minWidth ):
     startY = offset[1]
 #     startX = 74
 #     startY = 26
-     
-    for j in range(startY, height - offset[1], skipSize):
- 
-        for i in range(startX, width - offset[0], skipSize):
-            '''
-            1. check point
-            2. if point is good, try to trace outline
-            3. if there are enough points in the outline, add it to the list
-            '''
-            #test on 401x302
-            #took about 5.5 mins, most of which felt like the continuous loops
-             
-            square = getSquare(pixels, boxW, i, j)
-#             print('\nBegininng of standAlone loop',i,j)
-            #first examine the square to see if it's worth calculating
-            if sqrOk(square, avg, midContrast):
-                 
-                #the first result, theta, is ignored here
-                diff = checkPoint(square)[1]
- 
-                if absBiggerThan(diff, midContrast):
-#                     print('Right before getBestInRegion',i,j)
-                    p,t,d = getBestInRegion(pixels, width, height, boxW, i, j, int(skipSize/2), skipSize, 'n', avg, lowContrast)
-#                     print('\tRight after getBestInRegion',p)
- 
-                    if absBiggerThan(d, highContrast):
-#                         print('Right before getOutline',p)
-                        outline = getOutline(pixels, width, height, boxW, maxLength, p[0], p[1], avg, stdev)
-#                         print('t',i,j)
-#                         drawOutline(outline, im)
-#                         im.show()
-#                         return
-                        if len(outline) < 7 or getNetDeltaAngle(outline, 0, 0, len(outline)) > 0:
-                            continue
-                        
-#                         if outline[0] != (77, 25):
-#                             continue
-                        
-                        # split the outline here, before you fill it in.
-#                         splitOutlines = splitOutline( im, outline, outputIm1, outputIm2 )
-                        splitOutlines = splitOutline( im, outline, outputIm1 )
-                        
-                        print("First point in splitOutline: ", outline[0])
-                        print("len: ", len(splitOutlines))
-#                         fillOutline(outline, im, fillCol)
-#                         drawOutline(outline, im)
-#                         im.show()
-#                         im3 = im.copy()
-#                         drawOutline(outline, im3)
-#                         im3.show()
-#                         return
-                        
-                        if len(outlineList) > 0:
-                            fillOutline(outline, im2, fillCol)
-                        if splitOutlines == []:
-                            continue
-#                         splitOutlines = splitOutline( im, outline )
-                        outlineList.append(splitOutlines)
-                        print("SplitOutline Appended.\n")
-                        
-                        fillOutline(outline, im, fillCol)
-                        drawOutline(outline, im)
-#                         im3 = im.copy()
-#                         drawOutline(outline, im3)
-#                         im3.show()
-#                         im.show()
-#                         return
- 
-#             print( "\r{0:.3f}% checked".format( (float((j * (width-boxW) + i) * 100)/((height-boxW) * (width-boxW)))  ) )
-             
-#         print( "\r{0:.3f}% checked".format( (float((j - int(boxW/2)) * 100)/(height-boxW))  ) )
- 
-    print("100% checked")
-    print("Printing points")
-    outputIm1.show()
-#     outputIm1.save("largerOutput.bmp")
-#     outputIm2.show()
-#     outputIm2.save("largerOutput.bmp")
-     
-#     saveData(outlineList,"file.txt")
-    
-#     im.show()
-    print("Time to trace and split: ", datetime.datetime.now() - d1)
+    gridX = range(startX, width - offset[0], skipSize)
+    gridY = range(startY, height - offset[1], skipSize)
+    
+    labels = numpy.zeros((width, height), dtype=numpy.int32)
+    if images is not None:
+        images['im'] = im
+        images['outputIm1'] = outputIm1
+        # a view without the border, so the labels line up with the image
+        images['labels'] = labels[offset[0]:width - offset[0], offset[1]:height - offset[1]]
+    
+    stepper = getStepper(stepMode, minStep, maxStep)
+    if workers > 1:
+        # each tile makes its own stepper
+        fibers = traceInTiles(im, pixels, boxW, gridX, gridY, maxLength, avg, stdev, fillCol,
+                              axis = axis, orientationMode = orientationMode, cacheSize = cacheSize,
+                              useCandidateMap = useCandidateMap, workers = workers, tileSize = tileSize,
+                              tileHalo = tileHalo, traceMode = traceMode, imOffset = offset, stepMode = stepMode,
+                              minStep = minStep, maxStep = maxStep, candidateOrder = candidateOrder)
+    else:
+        field, cache, pyramid = getDetector(pixels, boxW, orientationMode, cacheSize, traceMode)
+        fibers = traceFibers(im, pixels, boxW, gridX, gridY, maxLength, avg, stdev, fillCol,
+                             axis = axis, field = field, cache = cache, useCandidateMap = useCandidateMap,
+                             outputIm1 = outputIm1, labels = labels, pyramid = pyramid, imOffset = offset,
+                             stepper = stepper, candidateOrder = candidateOrder)
     
 ##################
 
@@ -1557,20 +2331,15 @@ def standAlone( imPath, minWidth ):
 #     im.save("outlined"+imName[:len(imName)-3]+"bmp")
     
 #     return
-    start = 0
-    end = len(outlineList)
-    ellipseList = []
-
-    print("len(outlineList) = ", len(outlineList),"\n")
-    
-    for i2 in range(start, end):
-        splitList = outlineList[i2]
-#         possEll = []
-#         print("Checking item", i2, "out of", len(outlineList)) #not really checking that number; remember that it's
-                                                                #checking that collection of lists
-        for i3 in range(0, len(splitList)):
-            list1 = splitList[i3]
-#             print(i3, len(list1))
+    found = 0
+    for outline, splitOutlines in fibers:
+        found += 1
+        if workers > 1:
+            labelOutline(labels, outline, found)
+            fillOutline(shiftOutline(outline, -offset[0], -offset[1]), im, fillCol)
+            drawOutline(shiftOutline(outline, -offset[0], -offset[1]), im)
+        
+        for list1 in splitOutlines:
             a, b, h, k, t = solve(list1, minWidth/2)
             a = abs(a)
             b = abs(b)
@@ -1590,19 +2359,161 @@ def standAlone( imPath, minWidth ):
                 continue
             h -= offset[0]
             k -= offset[1]
-            fillEllipse(out, h, k, t, a, b, (255,255,255))
-            adjustedList = [ (p[0]-offset[0], p[1]-offset[1]) for p in list1 ]
-            try:
-                drawOutline(adjustedList, out)
-            except Exception:
-                ()
-            print("saving ellipse #", len(ellipseList), a, b, h, k, t)
-            ellipseList.append((h, k, t, a, b))
+            if withOutlines:
+                yield (h, k, t, a, b), [ (p[0]-offset[0], p[1]-offset[1]) for p in outline ], [ (p[0]-offset[0], p[1]-offset[1]) for p in list1 ]
+            else:
+                yield (h, k, t, a, b)
+    
+    if outputIm1 is not None:
+        os.makedirs(debugDir, exist_ok = True)
+        debugPath = os.path.join(debugDir, os.path.splitext(imName)[0] + "_splits.bmp")
+        print("Saving debug image to", debugPath)
+        Image.fromarray(outputIm1.transpose(1, 0, 2)).save(debugPath)
+#     outputIm1.save("largerOutput.bmp")
+#     outputIm2.show()
+#     outputIm2.save("largerOutput.bmp")
+     
+#     saveData(outlineList,"file.txt")
+    
+#     im.show()
+    print("Time to trace, split and fit: ", datetime.datetime.now() - d1)
+
+#runs detectFibers on the whole image and collects what it finds. Takes the same options as detectFibers.
+#returns the image with every traced outline filled in and drawn, an image of all the ellipses (and
+#the outlines they were fit to) in white on black, and the list of ellipses as (h, k, t, a, b).
+#returnLabels adds a fourth return value: an int array, indexed [x, y] like the image, where the pixels inside
+#the nth traced fiber are n (0 is background).
+def standAlone( imPath, minWidth, orientationMode = 'bisect', useCandidateMap = True, cacheSize = 100000, channelMode = 'rgb',
+                workers = 1, tileSize = 512, tileHalo = None, returnLabels = False, traceMode = 'direct', stepMode = 'fixed',
+                minStep = None, maxStep = None, debugDir = None, candidateOrder = 'raster' ):
+    d1 = datetime.datetime.now()
+    images = {}
+    out = Image.new("RGB", Image.open(imPath).size, (0,0,0))
+    ellipseList = []
+    fibers = detectFibers(imPath, minWidth, orientationMode = orientationMode, useCandidateMap = useCandidateMap,
+                          cacheSize = cacheSize, channelMode = channelMode, workers = workers, tileSize = tileSize,
+                          tileHalo = tileHalo, traceMode = traceMode, withOutlines = True, images = images,
+                          stepMode = stepMode, minStep = minStep, maxStep = maxStep, debugDir = debugDir,
+                          candidateOrder = candidateOrder)
+    for (h, k, t, a, b), outline, fitOutline in fibers:
+        fillEllipse(out, h, k, t, a, b, (255,255,255))
+        try:
+            drawOutline(fitOutline, out)
+        except Exception:
+            ()
+        print("saving ellipse #", len(ellipseList), a, b, h, k, t)
+        ellipseList.append((h, k, t, a, b))
 
     print("Time to find best fits: ", datetime.datetime.now() - d1)
-    return im, out, ellipseList
+    if returnLabels:
+        return images['im'], out, ellipseList, images['labels']
+    return images['im'], out, ellipseList
+
 
 
+# the kinds of files batchProcess picks up when it's given a directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+#the images batchProcess would work on: every image in pattern if it's a directory, otherwise every file it
+#matches as a glob.
+def getImagePaths( pattern ):
+    if os.path.isdir(pattern):
+        paths = [ os.path.join(pattern, name) for name in os.listdir(pattern)
+                  if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS ]
+    else:
+        paths = glob.glob(pattern)
+    return sorted( p for p in paths if os.path.isfile(p) )
+
+#the directory pattern's paths are named relative to: pattern itself if it's a directory, otherwise the part of
+#the glob before the first wildcard
+def getPatternRoot( pattern ):
+    if os.path.isdir(pattern):
+        return pattern
+    parts = []
+    for part in os.path.dirname(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or "."
+
+#a name for each image's output files, unique within the batch: its path relative to root without the extension,
+#so images in different folders keep their folders in outDir. Images that would still share a name (the same
+#name with different extensions) keep their extensions too.
+def getOutputNames( imPaths, root ):
+    names = {}
+    for imPath in imPaths:
+        names[imPath] = os.path.splitext(os.path.relpath(imPath, root))[0]
+    counts = {}
+    for name in names.values():
+        counts[name] = counts.get(name, 0) + 1
+    for imPath, name in names.items():
+        if counts[name] > 1:
+            names[imPath] = name + "_" + os.path.splitext(imPath)[1][1:]
+    return names
+
+#the part of batchProcess each worker runs: standAlone on one image. The ellipses are written to
+#<name>_ellipses.txt in outDir, one "h k t a b" line each, and the image of them to <name>_ellipses.bmp.
+#name comes from getOutputNames, and can have folders in it.
+def processImage( imPath, minWidth, outDir, name, options ):
+    im, out, ellipseList = standAlone(imPath, minWidth, **options)
+    outPath = os.path.join(outDir, name)
+    os.makedirs(os.path.dirname(outPath), exist_ok = True)
+    with open(outPath + "_ellipses.txt", 'w') as file:
+        for ellipse in ellipseList:
+            file.write(" ".join(str(x) for x in ellipse) + "\n")
+    out.save(outPath + "_ellipses.bmp")
+    return len(ellipseList)
+
+#reads the manifest batchProcess keeps in outDir: a dict from each finished image's path to its entry
+def loadManifest( manifestPath ):
+    finished = {}
+    if os.path.exists(manifestPath):
+        with open(manifestPath, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line can be cut off if the run was killed while writing it
+                    continue
+                finished[entry["image"]] = entry
+    return finished
+
+#runs standAlone on every image in a directory or glob (see getImagePaths), imageWorkers images at a time.
+#each image's results are written to outDir as soon as it's done (see processImage), and a line is added to
+#outDir/manifest.jsonl with its path, the parameters it ran with and its output name. Images already in the manifest with the
+#same parameters are skipped, so an interrupted run picks up where it left off.
+#options are passed on to standAlone, so options like workers (tile mode within each image) can still be given.
+def batchProcess( pattern = ".", minWidth = 15, outDir = "results", imageWorkers = None, **options ):
+    os.makedirs(outDir, exist_ok = True)
+    manifestPath = os.path.join(outDir, "manifest.jsonl")
+    finished = loadManifest(manifestPath)
+    imPaths = getImagePaths(pattern)
+    names = getOutputNames(imPaths, getPatternRoot(pattern))
+    
+    todo = []
+    for imPath in imPaths:
+        entry = finished.get(imPath)
+        if (entry is not None and entry["minWidth"] == minWidth and entry["options"] == options
+                and entry.get("output") == names[imPath]):
+            continue
+        todo.append(imPath)
+    print(len(todo), "images to process,", len(finished), "in the manifest")
+    
+    with ProcessPoolExecutor(max_workers = imageWorkers) as executor, open(manifestPath, 'a') as manifest:
+        futures = { executor.submit(processImage, imPath, minWidth, outDir, names[imPath], options) : imPath for imPath in todo }
+        for future in as_completed(futures):
+            imPath = futures[future]
+            try:
+                count = future.result()
+            except Exception as e:
+                # leave it out of the manifest, so it's tried again next time
+                print("Failed on", imPath, ":", repr(e))
+                continue
+            entry = { "image": imPath, "minWidth": minWidth, "options": options, "output": names[imPath],
+                      "ellipses": count, "finished": datetime.datetime.now().isoformat() }
+            manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+            print("Finished", imPath, "-", count, "ellipses")
 
 def main():
     d1 = datetime.datetime.now()
@@ -1635,7 +2546,13 @@ def main():
     print("Time elapsed:", diff)
 
 if __name__ == "__main__":
-    import cProfile
-    cProfile.run('main()')
+    # python main.py <directory or glob> [minWidth] [outDir] runs batchProcess on it
+    if len(sys.argv) > 1:
+        minW = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+        outDir = sys.argv[3] if len(sys.argv) > 3 else "results"
+        batchProcess(sys.argv[1], minW, outDir)
+    else:
+        import cProfile
+        cProfile.run('main()')
 #     main()
     
\ No newline at end of file